@@ -0,0 +1,113 @@
+import asyncio
+import collections
+import logging
+import time
+
+import discord
+
+
+logger = logging.getLogger(__name__)
+
+
+class BulkJob:
+    """Run an action over many items through a bounded pool of workers."""
+
+    def __init__(self, items, action, *, concurrency=5, progress=None, interval=2):
+        self.action = action
+        self.concurrency = concurrency
+        self.progress = progress
+        self.interval = interval
+        self.pending = collections.deque(items)
+        self.total = len(self.pending)
+        self.done = 0
+        self.failed = []
+        self.cancelled = False
+        self.last_progress = 0
+
+    @property
+    def finished(self):
+        return not self.pending
+
+    def cancel(self):
+        """Stop the job once the items in flight have been processed."""
+        self.cancelled = True
+
+    async def run(self):
+        """Process the pending items until they are all done or the job is cancelled."""
+        self.cancelled = False
+        workers = [
+            asyncio.ensure_future(self.worker())
+            for _ in range(min(self.concurrency, len(self.pending)))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        await self.report_progress(force=True)
+        return self
+
+    async def worker(self):
+        while self.pending and not self.cancelled:
+            item = self.pending.popleft()
+            try:
+                await self.action(item)
+            except asyncio.CancelledError:
+                self.pending.appendleft(item)
+                raise
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    # discord.py has already retried this, so back off before
+                    # handing the item to the next free worker.
+                    retry_after = float(e.response.headers.get("Retry-After", 1))
+                    logger.warning(f"Rate limited, retrying in {retry_after}s")
+                    self.pending.append(item)
+                    await asyncio.sleep(retry_after)
+                    continue
+                logger.warning(f"Bulk job action failed: {e}")
+                self.failed.append((item, e))
+            self.done += 1
+            await self.report_progress()
+
+    async def report_progress(self, force=False):
+        if self.progress is None:
+            return
+        now = time.monotonic()
+        if force or now - self.last_progress >= self.interval:
+            self.last_progress = now
+            await self.progress(self)
+
+
+async def sync_permissions(plan, *, concurrency=5, progress=None):
+    """Apply the overwrites in a plan of (channel, target, overwrite) entries,
+    skipping channels where the overwrite already matches."""
+    changes = [
+        (channel, target, overwrite)
+        for channel, target, overwrite in plan
+        if channel.overwrites_for(target)
+        != (overwrite or discord.PermissionOverwrite())
+    ]
+
+    async def apply(change):
+        channel, target, overwrite = change
+        await channel.set_permissions(target, overwrite=overwrite)
+
+    job = BulkJob(changes, apply, concurrency=concurrency, progress=progress)
+    return await job.run()
+
+
+def edit_progress(message, text):
+    """Create a progress callback which keeps a status message up to date."""
+
+    async def progress(job):
+        await message.edit(content=f"🔄 {text}... ({job.done}/{job.total})")
+
+    return progress
+
+
+def summarise_sync(plan, job):
+    """Describe the outcome of a permission sync."""
+    summary = f"{job.done - len(job.failed)} channels updated, {len(plan) - job.total} already in sync"
+    if job.failed:
+        summary += f", {len(job.failed)} failed"
+    return summary
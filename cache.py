@@ -0,0 +1,269 @@
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import os
+import sqlite3
+import time
+from settings import HTTP_CACHE_SIZE, HTTP_DISK_CACHE_SIZE
+
+
+DISK_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, status INTEGER,
+    encoding TEXT, etag TEXT, last_modified TEXT, hash TEXT, expires REAL, last_used REAL);
+CREATE INDEX IF NOT EXISTS responses_last_used_idx ON responses (last_used);
+CREATE TABLE IF NOT EXISTS bodies (hash TEXT PRIMARY KEY, data BLOB, size INTEGER);
+"""
+
+
+class ResponseCache:
+    """An in-memory LRU cache of responses with a TTL for each entry, bounded
+    by the total size of the response bodies.
+
+    Concurrent requests for the same key share a single upstream fetch."""
+
+    def __init__(self, max_bytes=HTTP_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Get an unexpired response, marking it as recently used."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, response = entry
+        if expires <= time.monotonic():
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return response
+
+    def set(self, key, response, ttl):
+        """Cache a response for `ttl` seconds, evicting the least recently used
+        responses to make room."""
+        size = len(response.body)
+        if size > self.max_bytes:
+            return
+        if response.expires is not None:
+            ttl = min(ttl, response.expires - time.time())
+        self.remove(key)
+        self.entries[key] = (time.monotonic() + ttl, response)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= len(evicted.body)
+            self.evictions += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= len(entry[1].body)
+
+    async def fetch(self, key, ttl, fetch):
+        """Get a response from the cache, or call `fetch` to get it. Callers
+        asking for the same key while it is being fetched wait for that fetch
+        instead of starting another."""
+        response = self.get(key)
+        if response is not None:
+            self.hits += 1
+            return response
+
+        future = self.inflight.get(key)
+        if future is None:
+            self.misses += 1
+            future = asyncio.ensure_future(self.load(key, ttl, fetch))
+            self.inflight[key] = future
+        else:
+            self.coalesced += 1
+        # Shielded so that one caller being cancelled doesn't cancel the fetch
+        # for everyone else waiting on it.
+        return await asyncio.shield(future)
+
+    async def load(self, key, ttl, fetch):
+        try:
+            response = await fetch()
+            if response.status == 200:
+                self.set(key, response, ttl)
+            return response
+        finally:
+            self.inflight.pop(key, None)
+
+    def get_stats(self):
+        """Retrieve the hit and miss counts and the size of the cache."""
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "max_size": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0,
+        }
+
+
+class TTLCache:
+    """An LRU cache of values which expire `ttl` seconds after being set,
+    bounded by the number of entries."""
+
+    def __init__(self, ttl, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class DiskCache:
+    """A persistent cache of responses in a SQLite database, so that cached
+    responses survive restarts.
+
+    Bodies are stored by the hash of their content, so identical responses
+    are only stored once. Expired responses are kept for revalidation with
+    their ETag or Last-Modified date until the least recently used responses
+    are evicted to keep the bodies under `max_bytes`. The database is only
+    used from one worker thread to keep disk access off the event loop."""
+
+    def __init__(self, directory, max_bytes=HTTP_DISK_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(
+            os.path.join(directory, "http_cache.db"), check_same_thread=False
+        )
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.executescript(DISK_CACHE_SCHEMA)
+
+    async def run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def get(self, key):
+        """Get a stored response, including expired ones which can still be
+        revalidated."""
+        entry = await self.run(self.load, key)
+        if entry is None:
+            self.misses += 1
+        elif entry["expires"] > time.time():
+            self.hits += 1
+        return entry
+
+    def load(self, key):
+        row = self.conn.execute(
+            "SELECT r.status, r.encoding, r.etag, r.last_modified, r.expires, b.data "
+            "FROM responses r JOIN bodies b ON b.hash = r.hash WHERE r.key = ?;",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+        with self.conn:
+            self.conn.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?;", (time.time(), key)
+            )
+        return dict(row)
+
+    async def set(self, key, response, ttl):
+        """Store a response for `ttl` seconds."""
+        await self.run(self.store, key, response, ttl)
+
+    def store(self, key, response, ttl):
+        content_hash = hashlib.sha256(response.body).hexdigest()
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO bodies (hash, data, size) VALUES (?, ?, ?);",
+                (content_hash, response.body, len(response.body)),
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, status, encoding, etag, last_modified, hash, expires, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+                (
+                    key,
+                    response.status,
+                    response.encoding,
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                    content_hash,
+                    now + ttl,
+                    now,
+                ),
+            )
+            self.delete_orphaned_bodies()
+        self.evict()
+
+    async def refresh(self, key, ttl):
+        """Extend the expiry of a response which the server says hasn't changed."""
+        self.revalidated += 1
+        await self.run(self.extend, key, ttl)
+
+    def extend(self, key, ttl):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE responses SET expires = ? WHERE key = ?;",
+                (time.time() + ttl, key),
+            )
+
+    def evict(self):
+        """Remove the least recently used responses until the bodies fit."""
+        while self.get_size() > self.max_bytes:
+            with self.conn:
+                deleted = self.conn.execute(
+                    "DELETE FROM responses WHERE key = "
+                    "(SELECT key FROM responses ORDER BY last_used LIMIT 1);"
+                ).rowcount
+                self.delete_orphaned_bodies()
+            if not deleted:
+                return
+            self.evictions += 1
+
+    def delete_orphaned_bodies(self):
+        self.conn.execute(
+            "DELETE FROM bodies WHERE hash NOT IN (SELECT hash FROM responses);"
+        )
+
+    def get_size(self):
+        return self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM bodies;"
+        ).fetchone()[0]
+
+    def get_stats(self):
+        """Retrieve the hit and miss counts of the disk cache."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "evictions": self.evictions,
+            "max_size": self.max_bytes,
+        }
+
+    def close(self):
+        self.executor.shutdown()
+        self.conn.close()
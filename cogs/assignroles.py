@@ -65,6 +65,8 @@ class AssignRoles(commands.Cog):
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload):
+        if payload.message_id not in self.bot.database.role_reactions:
+            return
         check = await self.bot.database.check_reaction(
             payload.message_id, payload.emoji
         )
@@ -99,6 +101,8 @@ class AssignRoles(commands.Cog):
 
     @commands.Cog.listener()
     async def on_raw_reaction_remove(self, payload):
+        if payload.message_id not in self.bot.database.role_reactions:
+            return
         check = await self.bot.database.check_reaction(
             payload.message_id, payload.emoji
         )
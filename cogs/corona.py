@@ -5,7 +5,6 @@ import logging
 from io import BytesIO
 from urllib.parse import urljoin
 
-import aiohttp
 import discord
 import matplotlib.pyplot as plt
 from bs4 import BeautifulSoup
@@ -13,6 +12,11 @@ from discord.ext import commands, tasks
 import numpy as np
 
 from settings import *
+from storage import leader_only
+
+
+# How long to cache the case numbers, in seconds.
+CORONA_CACHE_TTL = 10 * 60
 
 
 async def is_admin(ctx):
@@ -45,7 +49,8 @@ class TwitterAPI:
 
     API_URL = "https://api.twitter.com/1.1"
 
-    def __init__(self, consumer_key, consumer_secret):
+    def __init__(self, web, consumer_key, consumer_secret):
+        self.web = web
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
         self.encoded_key = self.encode_key()
@@ -65,28 +70,25 @@ class TwitterAPI:
         else:
             options["headers"] = {"Authorization": "Bearer " + self.bearer_key}
 
-        async with aiohttp.ClientSession() as session:
-            if not endpoint.startswith("/"):
-                endpoint = "/" + endpoint
-            url = self.API_URL + endpoint
+        if not endpoint.startswith("/"):
+            endpoint = "/" + endpoint
+        url = self.API_URL + endpoint
 
-            if method == "POST":
-                r = await session.post(url, **options)
-            elif method == "GET":
-                r = await session.get(url, **options)
-            else:
-                raise TypeError("Unknown request method type, use either GET or POST")
-            return await r.json()
+        if method == "POST":
+            r = await self.web.post(url, **options)
+        elif method == "GET":
+            r = await self.web.get(url, **options)
+        else:
+            raise TypeError("Unknown request method type, use either GET or POST")
+        return r.json()
 
     async def _get_bearer_key(self):
-        async with aiohttp.ClientSession() as session:
-            r = await session.post(
-                urljoin(self.API_URL, "oauth2/token"),
-                headers={"Authorization": "Basic " + self.encoded_key},
-                data={"grant_type": "client_credentials"},
-            )
-            data = await r.json()
-        return data.get("access_token")
+        r = await self.web.post(
+            urljoin(self.API_URL, "oauth2/token"),
+            headers={"Authorization": "Basic " + self.encoded_key},
+            data={"grant_type": "client_credentials"},
+        )
+        return r.json().get("access_token")
 
     async def get_latest_tweet(self, user):
         r = await self._request(
@@ -103,11 +105,14 @@ class Coronavirus(commands.Cog):
         self.last_graph = None
         self.last_graph_id = None
         self.check_announcements.start()
-        self.twitter_api = TwitterAPI(TWITTER_CONSUMER_KEY, TWITTER_CONSUMER_SECRET)
+        self.twitter_api = TwitterAPI(
+            bot.web, TWITTER_CONSUMER_KEY, TWITTER_CONSUMER_SECRET
+        )
         self.logger = logging.getLogger(__name__)
         self.logger.info("Coronavirus cog initialised.")
 
     @tasks.loop(seconds=10, reconnect=True)
+    @leader_only
     async def check_announcements(self):
         self.logger.debug("Checking for twitter updates")
         tweet = await self.twitter_api.get_latest_tweet("DHSCgovuk")
@@ -141,22 +146,20 @@ class Coronavirus(commands.Cog):
         country_row = None
         country = country.lower()
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://www.worldometers.info/coronavirus/#countries"
-            ) as response:
-                html = await response.text()
-                soup = BeautifulSoup(html, "html.parser")
-                rows = soup.select_one("tbody").find_all("tr")
+        response = await self.bot.web.get(
+            "https://www.worldometers.info/coronavirus/#countries", ttl=CORONA_CACHE_TTL
+        )
+        soup = BeautifulSoup(response.text(), "html.parser")
+        rows = soup.select_one("tbody").find_all("tr")
 
-                country_row = [
-                    r
-                    for r in rows
-                    if r.select_one("td").text.strip().lower() == country.lower()
-                ]
+        country_row = [
+            r
+            for r in rows
+            if r.select_one("td").text.strip().lower() == country.lower()
+        ]
 
-                if country.lower() in ["all", "world", "total"]:
-                    country_row = [soup.select_one(".total_row")]
+        if country.lower() in ["all", "world", "total"]:
+            country_row = [soup.select_one(".total_row")]
 
         if country_row:
             (
@@ -269,57 +272,55 @@ class Coronavirus(commands.Cog):
             return str(int(increase))
 
     async def get_uk_corona_stats(self):
-        async with aiohttp.ClientSession() as session:
-            params = {
-                "f": "json",
-                "where": "1=1",
-                "returnGeometry": "false",
-                "spatialRel": "esriSpatialRelIntersects",
-                "outFields": "*",
-                "orderByFields": "DateVal asc",
-                "resultOffset": 0,
-                "resultRecordCount": 2000,
-                "cacheHint": "true",
-            }
-
-            async with session.get(
-                "https://services1.arcgis.com/0IrmI40n5ZYxTUrV/arcgis/rest/services/DailyConfirmedCases/FeatureServer/0/query",
-                params=params,
-            ) as r:
-                data = await r.json(content_type="text/plain")
-
-            dates = [
-                datetime.date.fromtimestamp(f["attributes"]["DateVal"] / 1000)
-                for f in data["features"]
-            ]
-
-            cum_deaths = []
-            cum_cases = []
-            for f in data["features"]:
-                if f["attributes"]["CumDeaths"]:
-                    cum_deaths.append(f["attributes"]["CumDeaths"])
-                elif len(cum_deaths):
-                    cum_deaths.append(cum_deaths[-1])
-                else:
-                    cum_deaths.append(0)
-
-                if f["attributes"]["CumCases"]:
-                    cum_cases.append(f["attributes"]["CumCases"])
-                elif len(cum_deaths):
-                    cum_cases.append(cum_cases[-1])
-                else:
-                    cum_cases.append(0)
-
-            daily_cases = [
-                f["attributes"]["CMODateCount"]
-                if f["attributes"]["CMODateCount"]
-                else 0
-                for f in data["features"]
-            ]
-            daily_deaths = [
-                f["attributes"]["DailyDeaths"] if f["attributes"]["DailyDeaths"] else 0
-                for f in data["features"]
-            ]
+        params = {
+            "f": "json",
+            "where": "1=1",
+            "returnGeometry": "false",
+            "spatialRel": "esriSpatialRelIntersects",
+            "outFields": "*",
+            "orderByFields": "DateVal asc",
+            "resultOffset": 0,
+            "resultRecordCount": 2000,
+            "cacheHint": "true",
+        }
+
+        r = await self.bot.web.get(
+            "https://services1.arcgis.com/0IrmI40n5ZYxTUrV/arcgis/rest/services/DailyConfirmedCases/FeatureServer/0/query",
+            params=params,
+            ttl=CORONA_CACHE_TTL,
+        )
+        data = r.json()
+
+        dates = [
+            datetime.date.fromtimestamp(f["attributes"]["DateVal"] / 1000)
+            for f in data["features"]
+        ]
+
+        cum_deaths = []
+        cum_cases = []
+        for f in data["features"]:
+            if f["attributes"]["CumDeaths"]:
+                cum_deaths.append(f["attributes"]["CumDeaths"])
+            elif len(cum_deaths):
+                cum_deaths.append(cum_deaths[-1])
+            else:
+                cum_deaths.append(0)
+
+            if f["attributes"]["CumCases"]:
+                cum_cases.append(f["attributes"]["CumCases"])
+            elif len(cum_deaths):
+                cum_cases.append(cum_cases[-1])
+            else:
+                cum_cases.append(0)
+
+        daily_cases = [
+            f["attributes"]["CMODateCount"] if f["attributes"]["CMODateCount"] else 0
+            for f in data["features"]
+        ]
+        daily_deaths = [
+            f["attributes"]["DailyDeaths"] if f["attributes"]["DailyDeaths"] else 0
+            for f in data["features"]
+        ]
 
         return dates, cum_cases, cum_deaths, daily_cases, daily_deaths
 
@@ -417,17 +418,16 @@ class Coronavirus(commands.Cog):
         if self.last_graph_id == graph_id:
             return self.last_graph
 
-        async with aiohttp.ClientSession() as session:
-            headers = {"Authorization": f"Client-ID {IMGUR_CLIENT_ID}"}
-            data = {"image": file_data}
-            response = await session.post(
-                "https://api.imgur.com/3/image", headers=headers, data=data
-            )
-            response_json = await response.json()
-            if response_json["success"]:
-                self.last_graph_id = graph_id
-                self.last_graph = response_json["data"]["link"]
-                return response_json["data"]["link"]
+        headers = {"Authorization": f"Client-ID {IMGUR_CLIENT_ID}"}
+        data = {"image": file_data}
+        response = await self.bot.web.post(
+            "https://api.imgur.com/3/image", headers=headers, data=data
+        )
+        response_json = response.json()
+        if response_json["success"]:
+            self.last_graph_id = graph_id
+            self.last_graph = response_json["data"]["link"]
+            return response_json["data"]["link"]
 
 
 def setup(bot):
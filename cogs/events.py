@@ -50,8 +50,9 @@ class Events(commands.Cog):
         """View or set the welcome message."""
         if message is not None:
             if channel is not None:
-                await self.bot.database.set_setting("welcome_message", message)
-                await self.bot.database.set_setting("welcome_channel", str(channel.id))
+                await self.bot.database.set_settings(
+                    {"welcome_message": message, "welcome_channel": str(channel.id)}
+                )
             else:
                 await ctx.send(
                     "Please specify the channel to send the welcome message!"
@@ -3,12 +3,17 @@ import logging
 import re
 from io import BytesIO
 
-import aiohttp
 import discord
 from bs4 import BeautifulSoup
 from discord.ext import commands
 
 
+# How long to cache the responses from each API, in seconds.
+FACT_CACHE_TTL = 60 * 60
+EMOTE_SEARCH_CACHE_TTL = 60 * 60
+EMOTE_CACHE_TTL = 24 * 60 * 60
+
+
 async def is_admin(ctx):
     role_id = ctx.bot.database.settings.get("admin_role_id")
     role = ctx.guild.get_role(int(role_id))
@@ -25,13 +30,10 @@ class Fun(commands.Cog):
 
     @commands.command()
     async def factoftheday(self, ctx):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://uselessfacts.jsph.pl/today.json?language=en"
-            ) as response:
-                response = await response.json()
-
-        await ctx.send(response["text"])
+        response = await self.bot.web.get(
+            "https://uselessfacts.jsph.pl/today.json?language=en", ttl=FACT_CACHE_TTL
+        )
+        await ctx.send(response.json()["text"])
 
     @commands.command()
     async def bttv(self, ctx, *, query):
@@ -47,12 +49,13 @@ class Fun(commands.Cog):
         else:
             query = ""
 
-        async with aiohttp.ClientSession() as session:
-            params = {"q": query, "sort": "count-desc", "high_dpi": "on"}
-            async with session.get(
-                "https://www.frankerfacez.com/emoticons/", params=params
-            ) as response:
-                html = await response.text()
+        params = {"q": query, "sort": "count-desc", "high_dpi": "on"}
+        response = await self.bot.web.get(
+            "https://www.frankerfacez.com/emoticons/",
+            params=params,
+            ttl=EMOTE_SEARCH_CACHE_TTL,
+        )
+        html = response.text()
 
         soup = BeautifulSoup(html, "html.parser")
         rows = soup.select_one(".emote-table").find_all("tr", class_="selectable")
@@ -73,10 +76,9 @@ class Fun(commands.Cog):
         if emote_id:
             emoji_name = emoji_name[0]
             src = f"https://cdn.frankerfacez.com/emoticon/{emote_id[0]}/4"
-            async with aiohttp.ClientSession() as session:
-                async with session.get(src) as response:
-                    data = await response.read()
-                    f = discord.File(BytesIO(data), filename="emote.png")
+            response = await self.bot.web.get(src, ttl=EMOTE_CACHE_TTL)
+            data = response.read()
+            f = discord.File(BytesIO(data), filename="emote.png")
 
             if parsed.addemoji:
                 permission = await is_admin(ctx)
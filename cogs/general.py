@@ -1,28 +1,43 @@
 import inspect
+import collections
+import concurrent.futures
+import json
 import logging
 import time
 from io import BytesIO
 import datetime
 import sys
 import argparse
+import threading
 
 import discord
 from discord.ext import commands
 from fuzzywuzzy import process
-import aiohttp
 from matplotlib import style
 import matplotlib.pyplot as plt
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import psutil
 from googletrans import Translator
 import humanize
 
+from cache import TTLCache
 from settings import *
 import asyncio
 
 
 style.use("dark_background")
 
+# How long to cache the responses from each API, in seconds.
+DEFINITION_CACHE_TTL = 24 * 60 * 60
+WIKIPEDIA_CACHE_TTL = 60 * 60
+
+WIKIPEDIA_API_URL = "https://en.wikipedia.org/w/api.php"
+
+# googletrans is synchronous, so translations run in a small pool of threads,
+# each with its own translator, and the results are cached per line.
+TRANSLATE_WORKERS = 4
+TRANSLATION_CACHE_SIZE = 1024
+
 
 async def is_admin(ctx):
     role_id = ctx.bot.database.settings.get("admin_role_id")
@@ -38,8 +53,62 @@ class General(commands.Cog):
         self.bot.remove_command("help")
         self.start_time = time.time()
         self.logger = logging.getLogger(__name__)
+        self.translate_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=TRANSLATE_WORKERS
+        )
+        self.translators = threading.local()
+        self.translations = collections.OrderedDict()
+        # Searches and titles resolved to page IDs, and the extracts of each
+        # page by the number of sentences asked for.
+        self.wikipedia_titles = TTLCache(WIKIPEDIA_CACHE_TTL)
+        self.wikipedia_extracts = TTLCache(WIKIPEDIA_CACHE_TTL)
         self.logger.info("General cog initialised.")
 
+    def cog_unload(self):
+        self.translate_executor.shutdown(wait=False)
+
+    def translate_lines(self, lines, dest):
+        """Translate several lines in one request. Runs in a worker thread."""
+        translator = getattr(self.translators, "translator", None)
+        if translator is None:
+            translator = self.translators.translator = Translator()
+        translated = translator.translate("\n".join(lines), dest=dest)
+        results = translated.text.split("\n")
+        if len(results) != len(lines):
+            # The lines were merged or split in translation, so translate them
+            # one by one instead.
+            return [(t.text, t.src) for t in translator.translate(lines, dest=dest)]
+        return [(result, translated.src) for result in results]
+
+    async def translate_text(self, text, dest):
+        """Translate text line by line, only sending the lines which aren't
+        already cached. Returns the translation and the source language."""
+        lines = text.split("\n")
+        found = {}
+        for line in set(lines):
+            if (line, dest) in self.translations:
+                self.translations.move_to_end((line, dest))
+                found[line] = self.translations[(line, dest)]
+
+        missing = [
+            line for line in dict.fromkeys(lines) if line.strip() and line not in found
+        ]
+        if missing:
+            loop = asyncio.get_event_loop()
+            results = await loop.run_in_executor(
+                self.translate_executor, self.translate_lines, missing, dest
+            )
+            for line, result in zip(missing, results):
+                found[line] = self.translations[(line, dest)] = result
+                if len(self.translations) > TRANSLATION_CACHE_SIZE:
+                    self.translations.popitem(last=False)
+
+        translated = "\n".join(
+            found[line][0] if line in found else line for line in lines
+        )
+        sources = [found[line][1] for line in lines if line in found]
+        return translated, sources[0] if sources else dest
+
     def get_usage(self, command):
         """Get the usage details of a command."""
         args_spec = inspect.getfullargspec(command.callback)  # Get arguments of command
@@ -153,12 +222,12 @@ class General(commands.Cog):
     @commands.command()
     async def translate(self, ctx, dest_code, *, text):
         """Translate text using Google Translate."""
-        translator = Translator()
-        translated = translator.translate(text, dest=dest_code)
+        dest_code = dest_code.lower()
+        translated, src = await self.translate_text(text, dest_code)
         embed = discord.Embed(
             colour=EMBED_ACCENT_COLOUR,
-            title=f"Translate {translated.src.upper()} → {translated.dest.upper()}",
-            description=f"```{text}``` ```{translated.text}```",
+            title=f"Translate {src.upper()} → {dest_code.upper()}",
+            description=f"```{text}``` ```{translated}```",
         )
         embed.set_author(
             name="Google Translate",
@@ -172,13 +241,13 @@ class General(commands.Cog):
     @commands.command()
     async def define(self, ctx, *, term):
         """Get a definition from Merriam Webster."""
-        async with aiohttp.ClientSession() as session:
-            params = {"key": MERRIAM_WEBSTER_KEY}
-            async with session.get(
-                "https://dictionaryapi.com/api/v3/references/collegiate/json/" + term,
-                params=params,
-            ) as response:
-                data = await response.json()
+        params = {"key": MERRIAM_WEBSTER_KEY}
+        response = await self.bot.web.get(
+            "https://dictionaryapi.com/api/v3/references/collegiate/json/" + term,
+            params=params,
+            ttl=DEFINITION_CACHE_TTL,
+        )
+        data = response.json()
 
         embed = discord.Embed(colour=EMBED_ACCENT_COLOUR, title=term.title())
 
@@ -211,6 +280,66 @@ class General(commands.Cog):
 
         await ctx.send(embed=embed)
 
+    async def get_wikipedia_page(self, sentences, title=None, search=None):
+        """Get the URL, disambiguation flag and extract of a page, by title or
+        as the top search result, in a single request."""
+        key = ("search", search) if search is not None else ("title", title)
+        pageid = self.wikipedia_titles.get(key)
+        if pageid is not None:
+            page = self.wikipedia_extracts.get((pageid, sentences))
+            if page is not None:
+                return page
+            params = {"pageids": pageid}
+        elif search is not None:
+            params = {"generator": "search", "gsrsearch": search, "gsrlimit": 1}
+        else:
+            params = {"titles": title}
+
+        params.update(
+            {
+                "action": "query",
+                "prop": "info|pageprops|extracts",
+                "inprop": "url",
+                "ppprop": "disambiguation",
+                "explaintext": "",
+                "exsentences": sentences,
+                "redirects": "",
+                "format": "json",
+            }
+        )
+        r = await self.bot.web.get(
+            WIKIPEDIA_API_URL, params=params, ttl=WIKIPEDIA_CACHE_TTL
+        )
+        pages = r.json().get("query", {}).get("pages", {})
+        page = next((p for p in pages.values() if "missing" not in p), None)
+        if page is None:
+            return None
+
+        self.wikipedia_titles.set(key, page["pageid"])
+        self.wikipedia_titles.set(("title", page["title"]), page["pageid"])
+        self.wikipedia_extracts.set((page["pageid"], sentences), page)
+        return page
+
+    async def get_disambiguation_titles(self, pageid):
+        """Get the titles listed on a disambiguation page."""
+        params = {
+            "action": "parse",
+            "pageid": pageid,
+            "prop": "text",
+            "format": "json",
+            "formatversion": 2,
+        }
+        r = await self.bot.web.get(
+            WIKIPEDIA_API_URL, params=params, ttl=WIKIPEDIA_CACHE_TTL
+        )
+        html = r.json()["parse"]["text"]
+        soup = BeautifulSoup(html, "html.parser", parse_only=SoupStrainer("li"))
+        return [
+            li.a.get_text()
+            for li in soup.find_all("li")
+            if li.a and "tocsection" not in "".join(li.get("class", []))
+        ]
+
     @commands.command(aliases=["wiki"])
     async def wikipedia(self, ctx, *, query):
         """Search wikipedia with a query."""
@@ -223,151 +352,71 @@ class General(commands.Cog):
         query = " ".join(parsed.query)
         sentences = parsed.sentences
 
-        async with aiohttp.ClientSession() as session:
-            params = {
-                "action": "query",
-                "list": "search",
-                "srprop": "",
-                "srlimit": 1,
-                "limit": 1,
-                "srsearch": query,
-                "srinfo": "suggestion",
-                "format": "json",
-            }
-
-            async with session.get(
-                "https://en.wikipedia.org/w/api.php", params=params
-            ) as r:
-                data = await r.json()
-                if not data["query"]["search"]:
-                    await ctx.send(
-                        "I could not find any wikipedia pages with that query!"
-                    )
-                    return
-                title = data["query"]["search"][0]["title"]
-                pageid = data["query"]["search"][0]["pageid"]
-
-            params = {
-                "action": "query",
-                "prop": "info|pageprops",
-                "inprop": "url",
-                "ppprop": "disambiguation",
-                "redirects": "",
-                "titles": title,
-                "format": "json",
-            }
-
-            async with session.get(
-                "https://en.wikipedia.org/w/api.php", params=params
-            ) as r:
-                data = await r.json()
-                url = data["query"]["pages"][str(pageid)]["fullurl"]
-
-            if data["query"]["pages"][str(pageid)].get("pageprops"):
-
-                params = {
-                    "action": "query",
-                    "prop": "revisions",
-                    "rvprop": "content",
-                    "rvparse": "",
-                    "titles": title,
-                    "format": "json",
-                }
-
-                async with session.get(
-                    "https://en.wikipedia.org/w/api.php", params=params
-                ) as r:
-                    data = await r.json()
-                    html = data["query"]["pages"][str(pageid)]["revisions"][0]["*"]
-                    soup = BeautifulSoup(html, "html.parser")
-                    lis = soup.find_all("li")
-                    filtered_lis = [
-                        li
-                        for li in lis
-                        if not "tocsection" in "".join(li.get("class", []))
-                    ]
-                    may_refer_to = [li.a.get_text() for li in filtered_lis if li.a]
-
-                embed = discord.Embed(
-                    colour=EMBED_ACCENT_COLOUR,
-                    title=title,
-                    description=f"{title} may refer to:\n\n"
-                    + "\n".join(
-                        [f"**{n}.** {r}" for n, r in enumerate(may_refer_to, start=1)]
-                    )
-                    + "\n\n**Enter the number of the wikipedia page you would like to see.**",
-                )
-                embed.set_author(
-                    name="Wikipedia",
-                    url=url,
-                    icon_url="https://upload.wikimedia.org/wikipedia/en/thumb/8/80/Wikipedia-logo-v2.svg/1200px-Wikipedia-logo-v2.svg.png",
-                )
-                tmp = await ctx.send(embed=embed)
-
-                def check(m):
-                    if (
-                        m.content.isdigit()
-                        and m.author == ctx.author
-                        and m.channel == ctx.channel
-                    ):
-                        return 0 <= int(m.content) - 1 <= len(may_refer_to)
-
-                try:
-                    response = await self.bot.wait_for(
-                        "message", check=check, timeout=60
-                    )
-                except asyncio.TimeoutError:
-                    return
-                else:
-                    await tmp.delete()
-                    try:
-                        await response.delete()
-                    except:
-                        pass
-
-                    title = may_refer_to[int(response.content) - 1]
-
-                    params = {
-                        "action": "query",
-                        "prop": "info|pageprops",
-                        "inprop": "url",
-                        "ppprop": "disambiguation",
-                        "redirects": "",
-                        "titles": title,
-                        "format": "json",
-                    }
-
-                    async with session.get(
-                        "https://en.wikipedia.org/w/api.php", params=params
-                    ) as r:
-                        data = await r.json()
-                        pageid = int(list(data["query"]["pages"].keys())[0])
-                        url = data["query"]["pages"][str(pageid)]["fullurl"]
-
-            params = {
-                "action": "query",
-                "prop": "extracts",
-                "explaintext": "",
-                "exsentences": sentences,
-                "titles": title,
-                "format": "json",
-            }
+        page = await self.get_wikipedia_page(sentences, search=query)
+        if page is None:
+            await ctx.send("I could not find any wikipedia pages with that query!")
+            return
+        title = page["title"]
+        url = page["fullurl"]
 
-            async with session.get(
-                "https://en.wikipedia.org/w/api.php", params=params
-            ) as r:
-                data = await r.json()
-                summary = data["query"]["pages"][str(pageid)]["extract"]
+        if page.get("pageprops"):
+            may_refer_to = await self.get_disambiguation_titles(page["pageid"])
 
             embed = discord.Embed(
-                colour=EMBED_ACCENT_COLOUR, title=title, description=summary
+                colour=EMBED_ACCENT_COLOUR,
+                title=title,
+                description=f"{title} may refer to:\n\n"
+                + "\n".join(
+                    [f"**{n}.** {r}" for n, r in enumerate(may_refer_to, start=1)]
+                )
+                + "\n\n**Enter the number of the wikipedia page you would like to see.**",
             )
             embed.set_author(
                 name="Wikipedia",
                 url=url,
                 icon_url="https://upload.wikimedia.org/wikipedia/en/thumb/8/80/Wikipedia-logo-v2.svg/1200px-Wikipedia-logo-v2.svg.png",
             )
-            await ctx.send(embed=embed)
+            tmp = await ctx.send(embed=embed)
+
+            def check(m):
+                if (
+                    m.content.isdigit()
+                    and m.author == ctx.author
+                    and m.channel == ctx.channel
+                ):
+                    return 0 <= int(m.content) - 1 <= len(may_refer_to)
+
+            try:
+                response = await self.bot.wait_for("message", check=check, timeout=60)
+            except asyncio.TimeoutError:
+                return
+            else:
+                await tmp.delete()
+                try:
+                    await response.delete()
+                except:
+                    pass
+
+                title = may_refer_to[int(response.content) - 1]
+
+                page = await self.get_wikipedia_page(sentences, title=title)
+                if page is None:
+                    await ctx.send("I could not find that wikipedia page!")
+                    return
+                title = page["title"]
+                url = page["fullurl"]
+
+        summary = page.get("extract", "")
+
+        embed = discord.Embed(
+            colour=EMBED_ACCENT_COLOUR, title=title, description=summary
+        )
+        embed.set_author(
+            name="Wikipedia",
+            url=url,
+            icon_url="https://upload.wikimedia.org/wikipedia/en/thumb/8/80/Wikipedia-logo-v2.svg/1200px-Wikipedia-logo-v2.svg.png",
+        )
+        await ctx.send(embed=embed)
 
     @commands.command()
     async def weather(self, ctx, *, location):
@@ -426,7 +475,11 @@ class General(commands.Cog):
 
     @commands.command()
     async def info(self, ctx):
-        total_rows = await self.bot.database.get_total_rows()
+        table_stats = await self.bot.database.get_table_stats()
+        total_rows = sum(s["rows"] for s in table_stats.values())
+        total_size = humanize.naturalsize(sum(s["size"] for s in table_stats.values()))
+        pool_stats = self.bot.database.get_pool_stats()
+        cache_stats = self.bot.web.cache.get_stats()
         cpu_usage = psutil.cpu_percent()
         ram_usage = psutil.virtual_memory().percent
         latency = self.bot.latency
@@ -446,7 +499,27 @@ class General(commands.Cog):
             name="Version",
             value=f"Python {python_version}\nDiscord.py {discord.__version__}",
         )
-        embed.add_field(name="Database Records", value=f"{total_rows}/10000")
+        embed.add_field(
+            name="Database Records", value=f"{total_rows}/{ROW_BUDGET}\n{total_size}"
+        )
+        embed.add_field(
+            name="Database Pool",
+            value=f"{pool_stats['in_use']}/{pool_stats['size']} in use\n"
+            f"{pool_stats['waiting']} waiting\n"
+            f"{round(pool_stats['average_acquire_time']*1000)}ms average acquire",
+        )
+        cache_info = (
+            f"{round(cache_stats['hit_rate'] * 100)}% hit rate\n"
+            f"{cache_stats['entries']} responses\n"
+            f"{humanize.naturalsize(cache_stats['size'])}"
+        )
+        if self.bot.web.disk_cache:
+            disk_stats = self.bot.web.disk_cache.get_stats()
+            cache_info += (
+                f"\n{disk_stats['hits']} disk hits, "
+                f"{disk_stats['revalidated']} revalidated"
+            )
+        embed.add_field(name="HTTP Cache", value=cache_info)
         embed.add_field(name="CPU Usage", value=f"{cpu_usage}%")
         embed.add_field(name="RAM Usage", value=f"{ram_usage}%")
         embed.add_field(
@@ -455,6 +528,72 @@ class General(commands.Cog):
         embed.add_field(name="Uptime", value=str(uptime))
         await ctx.send(embed=embed)
 
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def schema(self, ctx):
+        """View the database schema version and index usage."""
+        version = await self.bot.database.get_schema_version()
+        usage = await self.bot.database.get_index_usage()
+        embed = discord.Embed(
+            colour=EMBED_ACCENT_COLOUR,
+            title="Database Schema",
+            description=f"Schema version `{version}`",
+        )
+        tables = {}
+        for table_name, seq_scan, index_name, idx_scan in usage:
+            lines = tables.setdefault(table_name, [f"Sequential scans: {seq_scan}"])
+            if index_name:
+                lines.append(f"`{index_name}`: {idx_scan} scans")
+        for table_name, lines in tables.items():
+            embed.add_field(name=table_name, value="\n".join(lines), inline=False)
+        await ctx.send(embed=embed)
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def queries(self, ctx, action=None):
+        """View the slowest database methods, `-queries dump` for the full
+        metrics as JSON, or `-queries reset` to start counting again."""
+        metrics = self.bot.database.metrics
+        if action == "reset":
+            metrics.reset()
+            await ctx.send("✅ Query metrics have been reset.")
+            return
+
+        snapshot = metrics.snapshot()
+        if action == "dump":
+            snapshot["pool"] = self.bot.database.get_pool_stats()
+            snapshot["helper_role_cache"] = (
+                self.bot.database.get_helper_role_cache_stats()
+            )
+            data = json.dumps(snapshot, indent=2).encode()
+            await ctx.send(file=discord.File(BytesIO(data), filename="queries.json"))
+            return
+
+        methods = sorted(
+            snapshot["methods"].items(), key=lambda m: m[1]["total_time"], reverse=True
+        )
+        since = humanize.naturaldelta(
+            datetime.timedelta(seconds=time.time() - snapshot["since"])
+        )
+        embed = discord.Embed(
+            colour=EMBED_ACCENT_COLOUR,
+            title="Database Queries",
+            description=f"Recorded over the last {since}, "
+            f"{len(snapshot['slow_queries'])} slow queries.",
+        )
+        for method, stats in methods[:10]:
+            if stats["p95"]:
+                p95 = f"p95 ≤ {stats['p95'] * 1000:g}ms"
+            else:
+                p95 = f"p95 > {snapshot['buckets'][-1]}s"
+            embed.add_field(
+                name=method,
+                value=f"{stats['queries']} queries, {stats['rows']} rows\n"
+                f"{round(stats['average_time'] * 1000, 1)}ms average\n"
+                f"{p95}, max {round(stats['max_time'] * 1000)}ms",
+            )
+        await ctx.send(embed=embed)
+
     @commands.command(hidden=True)
     @commands.is_owner()
     async def reload(self, ctx, plugin):
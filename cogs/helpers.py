@@ -5,6 +5,7 @@ import discord
 from discord.ext import commands
 
 from settings import *
+from bulk import sync_permissions, edit_progress, summarise_sync
 
 
 async def is_admin(ctx):
@@ -67,8 +68,9 @@ class Helpers(commands.Cog):
     @commands.guild_only()
     async def setglobalhelperrole(self, ctx, *, role: discord.Role):
         """Sets the global helper role."""
-        await self.bot.database.set_setting("helper_role_guild_id", str(ctx.guild.id))
-        await self.bot.database.set_setting("helper_role_id", str(role.id))
+        await self.bot.database.set_settings(
+            {"helper_role_guild_id": str(ctx.guild.id), "helper_role_id": str(role.id)}
+        )
         await ctx.send(f"✅ {role.mention} is now set as the helper role.")
 
     @commands.command()
@@ -92,13 +94,16 @@ class Helpers(commands.Cog):
     async def helperroles(self, ctx):
         """Get all helper roles for a channel."""
         string = ""
+        stale_role_ids = []
         helper_roles = await self.bot.database.get_helper_roles(ctx.channel)
         for r in helper_roles:
             role = ctx.guild.get_role(r)
             if role:
                 string += role.name + "\n"
             else:
-                await self.bot.database.remove_helper_role(ctx.channel, r)
+                stale_role_ids.append(r)
+        if stale_role_ids:
+            await self.bot.database.remove_helper_roles(ctx.channel, stale_role_ids)
 
         embed = discord.Embed(
             colour=EMBED_ACCENT_COLOUR,
@@ -115,10 +120,12 @@ class Helpers(commands.Cog):
         roles = [ctx.guild.get_role(r) for r in role_ids]
         role_mentions = []
         role_previous_setting = []
+        stale_role_ids = [r for r, role in zip(role_ids, roles) if role is None]
+        if stale_role_ids:
+            await self.bot.database.remove_helper_roles(ctx.channel, stale_role_ids)
 
         for role_id, role in zip(role_ids, roles):
             if role is None:
-                await self.bot.database.remove_helper_role(ctx.channel, role_id)
                 continue
             previous_setting = role.mentionable
             if not role.mentionable:
@@ -141,27 +148,34 @@ class Helpers(commands.Cog):
     @commands.guild_only()
     @commands.check(is_admin)
     async def synchelperperms(self, ctx):
-        results = await self.bot.database.conn.fetch("SELECT * FROM helper_roles;")
+        helper_roles = await self.bot.database.get_all_helper_roles()
         perm_overwrite = discord.PermissionOverwrite(read_messages=True)
 
         msg = await ctx.send("🔄 Setting up permissions...")
 
-        for r in results:
-            channel = ctx.guild.get_channel(r["channel_id"])
-            if channel:
-                role = ctx.guild.get_role(r["role_id"])
+        plan = []
+        stale_channel_ids = set()
+        stale_role_ids = set()
+        for channel_id, role_ids in helper_roles.items():
+            channel = ctx.guild.get_channel(channel_id)
+            if not channel:
+                stale_channel_ids.add(channel_id)
+                continue
+            for role_id in role_ids:
+                role = ctx.guild.get_role(role_id)
                 if role:
-                    await channel.set_permissions(role, overwrite=perm_overwrite)
+                    plan.append((channel, role, perm_overwrite))
                 else:
-                    await self.bot.database.conn.execute(
-                        "DELETE FROM helper_roles WHERE role_id=$1;", r["role_id"]
-                    )
-            else:
-                await self.bot.database.conn.execute(
-                    "DELETE FROM helper_roles WHERE channel_id=$1;", r["channel_id"]
-                )
+                    stale_role_ids.add(role_id)
 
-        await msg.edit(content=f"✅ Helper permissions are now in sync!")
+        await self.bot.database.prune_helper_roles(stale_channel_ids, stale_role_ids)
+        job = await sync_permissions(
+            plan, progress=edit_progress(msg, "Setting up permissions")
+        )
+
+        await msg.edit(
+            content=f"✅ Helper permissions are now in sync! ({summarise_sync(plan, job)})"
+        )
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -175,48 +189,57 @@ class Helpers(commands.Cog):
     @commands.guild_only()
     async def setreps(self, ctx, *, query: str = None):
         """Configure the reputation points. (Admin only)
-        
+
         Command options:
-        -setreps set <member> <amount>
-        -setreps remove <member> <amount>
-        -setreps add <member> <amount>
+        -setreps set <member> [member...] <amount>
+        -setreps remove <member> [member...] <amount>
+        -setreps add <member> [member...] <amount>
         -setreps clear"""
         if query is not None:
             args = [a.strip() for a in query.split()]
             if args[0].lower() in ["set", "remove", "add"]:
-                if len(args) != 3:
+                if len(args) < 3:
                     raise Exception("Invalid options.")
-                member = ctx.guild.get_member_named(args[1])
-                if not member and not ctx.message.mentions:
-                    raise Exception("Member not found")
-                elif not member:
-                    member = ctx.message.mentions[0]
-                amount = args[2]
+                if ctx.message.mentions:
+                    members = ctx.message.mentions
+                else:
+                    members = [ctx.guild.get_member_named(a) for a in args[1:-1]]
+                    if None in members:
+                        raise Exception("Member not found")
+                amount = args[-1]
                 if not amount.isdigit():
                     raise Exception("Amount must be an integer")
                 amount = int(amount)
+                mentions = ", ".join(m.mention for m in members)
 
                 if args[0].lower() == "set":
-                    new_points = await self.bot.database.set_reps(member, amount)
+                    new_points = await self.bot.database.set_reps_bulk(members, amount)
                     embed = discord.Embed(
                         colour=EMBED_ACCENT_COLOUR,
-                        description=f"🏅 {ctx.author.mention} set {member.mention}'s reputation points to {new_points}",
+                        description=f"🏅 {ctx.author.mention} set {mentions}'s reputation points to {new_points[members[0].id]}",
                     )
                 elif args[0].lower() == "remove":
-                    new_points = await self.bot.database.add_rep(member, amount=-amount)
+                    new_points = await self.bot.database.add_reps_bulk(
+                        members, amount=-amount
+                    )
                     embed = discord.Embed(
                         colour=EMBED_ACCENT_COLOUR,
-                        description=f"🏅 {ctx.author.mention} removed {amount} reputation points from {member.mention}",
+                        description=f"🏅 {ctx.author.mention} removed {amount} reputation points from {mentions}",
                     )
                 elif args[0].lower() == "add":
-                    new_points = await self.bot.database.add_rep(member, amount=amount)
+                    new_points = await self.bot.database.add_reps_bulk(
+                        members, amount=amount
+                    )
                     embed = discord.Embed(
                         colour=EMBED_ACCENT_COLOUR,
-                        description=f"🏅 {ctx.author.mention} added {amount} reputation points from {member.mention}",
+                        description=f"🏅 {ctx.author.mention} added {amount} reputation points to {mentions}",
                     )
                 await self.bot.get_cog("Moderation").log(embed)
                 await ctx.send(
-                    f"✅ {member.mention} now has `{new_points}` reputation points!"
+                    "\n".join(
+                        f"✅ {m.mention} now has `{new_points[m.id]}` reputation points!"
+                        for m in members
+                    )
                 )
             elif args[0].lower() == "clear":
                 await self.remove_all_reps(ctx)
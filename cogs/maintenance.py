@@ -0,0 +1,83 @@
+import logging
+import time
+
+import discord
+from discord.ext import commands, tasks
+
+from settings import *
+from storage import leader_only
+
+
+class Maintenance(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.budget_warning_sent = False
+        self.enforce_retention.start()
+        self.logger = logging.getLogger(__name__)
+        self.logger.info("Maintenance cog initialised.")
+
+    def cog_unload(self):
+        self.enforce_retention.cancel()
+
+    async def apply_retention(self, dry_run=False):
+        """Apply the retention policies, returning how many rows were removed from each table."""
+        cutoff = time.time() - WARNING_RETENTION_DAYS * 24 * 60 * 60
+        tweets = await self.bot.database.prune_tweets(TWEET_RETENTION, dry_run=dry_run)
+        warnings = await self.bot.database.archive_warnings(
+            cutoff, archive_dir=WARNING_ARCHIVE_DIR, dry_run=dry_run
+        )
+        return {"corona_tweets": tweets, "warnings": warnings}
+
+    async def check_row_budget(self):
+        """Warn the moderators when the database is close to its row budget."""
+        total_rows = await self.bot.database.get_total_rows(exact=True)
+        if total_rows < ROW_BUDGET * ROW_BUDGET_WARNING:
+            self.budget_warning_sent = False
+            return
+        self.logger.warning(f"Database is using {total_rows}/{ROW_BUDGET} rows")
+        moderation = self.bot.get_cog("Moderation")
+        if moderation and not self.budget_warning_sent:
+            self.budget_warning_sent = True
+            embed = discord.Embed(
+                colour=0xFF0000,
+                description=f"💾 The database is using {total_rows}/{ROW_BUDGET} rows, "
+                "new records will fail to save once the limit is reached.",
+            )
+            await moderation.log(embed)
+
+    @tasks.loop(hours=6, reconnect=True)
+    @leader_only
+    async def enforce_retention(self):
+        removed = await self.apply_retention()
+        self.logger.info(f"Retention policies removed {removed}")
+        await self.check_row_budget()
+
+    @enforce_retention.before_loop
+    async def before_enforce_retention(self):
+        await self.bot.wait_until_ready()
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def retention(self, ctx, action=None):
+        """Preview the retention policies, or run them with `-retention apply`."""
+        dry_run = action != "apply"
+        removed = await self.apply_retention(dry_run=dry_run)
+        stats = await self.bot.database.get_table_stats(exact=True)
+        total_rows = sum(s["rows"] for s in stats.values())
+
+        embed = discord.Embed(
+            colour=EMBED_ACCENT_COLOUR,
+            title="Retention Report" + (" (Dry Run)" if dry_run else ""),
+            description=f"The database is using `{total_rows}/{ROW_BUDGET}` rows.",
+        )
+        for table, amount in removed.items():
+            verb = "Would remove" if dry_run else "Removed"
+            embed.add_field(
+                name=table,
+                value=f"{stats.get(table, {}).get('rows', 0)} rows\n{verb} {amount}",
+            )
+        await ctx.send(embed=embed)
+
+
+def setup(bot):
+    bot.add_cog(Maintenance(bot))
@@ -1,5 +1,6 @@
 import asyncio
 import datetime
+import heapq
 import logging
 import re
 import time
@@ -11,6 +12,8 @@ import aiohttp
 import humanize
 
 from settings import *
+from storage import leader_only
+from bulk import BulkJob, sync_permissions, edit_progress, summarise_sync
 
 
 async def is_admin(ctx):
@@ -29,6 +32,41 @@ async def is_mod(ctx):
     return ctx.author.id == 206079414709125120
 
 
+class BanCache:
+    """A short-lived cache of guild bans, resolved one user at a time."""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.entries = {}
+
+    def set(self, guild_id, user_id, user):
+        """Record a banned user, or None if the user is not banned."""
+        now = time.monotonic()
+        if len(self.entries) > 1000:
+            self.entries = {k: v for k, v in self.entries.items() if v[0] > now}
+        self.entries[(guild_id, user_id)] = (now + self.ttl, user)
+
+    async def get_ban(self, guild, user_id):
+        """Get a banned user, or None if the user is not banned."""
+        entry = self.entries.get((guild.id, user_id))
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        try:
+            ban = await guild.fetch_ban(discord.Object(id=user_id))
+        except discord.NotFound:
+            user = None
+        else:
+            user = ban.user
+        self.set(guild.id, user_id, user)
+        return user
+
+    async def get_bans(self, guild, user_ids):
+        """Resolve several bans concurrently."""
+        user_ids = list(set(user_ids))
+        users = await asyncio.gather(*[self.get_ban(guild, u) for u in user_ids])
+        return dict(zip(user_ids, users))
+
+
 class Moderation(commands.Cog):
 
     BAN = "b"
@@ -37,16 +75,33 @@ class Moderation(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        self.bans = BanCache()
+        self.role_shifts = {}
+        self.punishment_queue = []
+        self.punishment_added = asyncio.Event()
+        self.punishment_scheduler = self.bot.loop.create_task(
+            self.schedule_punishments()
+        )
         self.check_expired_punishments.start()
+        self.bot.database.add_change_listener(
+            "temporary_punishments", self.reload_punishments
+        )
         self.logger = logging.Logger(__name__)
         self.logger.info("Moderation cog initialised.")
 
+    def cog_unload(self):
+        self.punishment_scheduler.cancel()
+        self.check_expired_punishments.cancel()
+        self.bot.database.remove_change_listener(
+            "temporary_punishments", self.reload_punishments
+        )
+
     @commands.command()
     @commands.has_permissions(administrator=True)
     @commands.guild_only()
     async def adminrole(self, ctx, *, role: discord.Role = None):
         await self.setrole(ctx, role, "admin_role")
-    
+
     @commands.guild_only()
     @commands.check(is_admin)
     @commands.command()
@@ -74,8 +129,9 @@ class Moderation(commands.Cog):
             else:
                 await ctx.send(f"The {name.replace('_', ' ')} is not set.")
         else:
-            await self.bot.database.set_setting(name + "_guild_id", str(ctx.guild.id))
-            await self.bot.database.set_setting(name + "_id", str(role.id))
+            await self.bot.database.set_settings(
+                {name + "_guild_id": str(ctx.guild.id), name + "_id": str(role.id)}
+            )
             await ctx.send(
                 f"✅ {role.mention} is now set as the {name.replace('_', ' ')}."
             )
@@ -85,27 +141,71 @@ class Moderation(commands.Cog):
     @commands.check(is_admin)
     async def shiftmemberroles(self, ctx, old: commands.Greedy[discord.Role], flags: str, new: commands.Greedy[discord.Role]):
         """Moves all members that have at least one of the specified roles role to the other.
-        By default, removes the old role. If the "+" flag is passed, this is not removed."""
-        old_members = []
-        for i in range(len(old)):
-            role_members = old[i].members
-            for member in role_members:
-                if member not in old_members:
-                    old_members.append(member)
-        msg = await ctx.send("(0%) Shifting member roles...")
-        total = len(old_members)
-        percent = 0
-        for n, member in enumerate(old_members):
+        The "+" flag adds the new roles and the "-" flag removes the old roles.
+        Use `-cancelshift` to stop a running shift and `-resumeshift` to continue it."""
+        job = self.role_shifts.get(ctx.guild.id)
+        if job and not job.finished:
+            await ctx.send(
+                "A role shift is already in progress, use `-cancelshift` or `-resumeshift`."
+            )
+            return
+
+        old_roles = set(old)
+        new_roles = set(new)
+        old_members = {member for role in old_roles for member in role.members}
+
+        async def shift(member):
+            current_roles = set(member.roles[1:])
+            roles = set(current_roles)
             if "+" in flags:
-                await member.add_roles(*new)
+                roles |= new_roles
             if "-" in flags:
-                await member.remove_roles(*old)
-            p = int((n / total) * 10) * 10
-            if p != percent:
-                percent = p
-                await msg.edit(content=f"({percent}%) Shifting member roles...")
-        await msg.edit(content=f"(100%) Member roles were shifted")
-    
+                roles -= old_roles
+            if roles != current_roles:
+                await member.edit(
+                    roles=list(roles), reason=f"Roles shifted by {ctx.author}"
+                )
+
+        job = BulkJob(old_members, shift)
+        self.role_shifts[ctx.guild.id] = job
+        await self.run_role_shift(ctx, job)
+
+    @commands.command()
+    @commands.guild_only()
+    @commands.check(is_admin)
+    async def cancelshift(self, ctx):
+        """Cancel the role shift in progress."""
+        job = self.role_shifts.get(ctx.guild.id)
+        if job and not job.finished:
+            job.cancel()
+        else:
+            await ctx.send("There is no role shift in progress.")
+
+    @commands.command()
+    @commands.guild_only()
+    @commands.check(is_admin)
+    async def resumeshift(self, ctx):
+        """Resume a cancelled role shift."""
+        job = self.role_shifts.get(ctx.guild.id)
+        if job and not job.finished and job.cancelled:
+            await self.run_role_shift(ctx, job)
+        else:
+            await ctx.send("There is no cancelled role shift to resume.")
+
+    async def run_role_shift(self, ctx, job):
+        msg = await ctx.send("🔄 Shifting member roles...")
+        job.progress = edit_progress(msg, "Shifting member roles")
+        await job.run()
+        if job.finished:
+            content = f"✅ Member roles were shifted for {job.done} members"
+            if job.failed:
+                content += f" ({len(job.failed)} failed)"
+        else:
+            content = (
+                f"⏸️ Role shift cancelled with {len(job.pending)} members remaining, "
+                "use `-resumeshift` to continue."
+            )
+        await msg.edit(content=content)
 
     # @commands.command(hidden=True)
     # @commands.guild_only()
@@ -164,8 +264,7 @@ class Moderation(commands.Cog):
             await ctx.send("You cannot warn this user.")
             return
 
-        current_warnings = await self.bot.database.get_warnings(member)
-        current_amount = len(current_warnings)
+        current_amount = await self.bot.database.get_warning_count(member)
         if current_amount == 4:
             reason += " (5TH WARNING)"
         elif current_amount == 9:
@@ -188,23 +287,22 @@ class Moderation(commands.Cog):
     @commands.check(is_mod)
     async def warnings(self, ctx, member: discord.Member, page: int = 1):
         """Retrieve all the warnings that a user has been given."""
-        warnings = await self.bot.database.get_warnings(member)
+        total, last_warning = await self.bot.database.get_warning_summary(member)
 
-        pages = (len(warnings) - 1) // 6 + 1
+        pages = (total - 1) // 6 + 1
         if page > pages:
             page = pages
         elif page < 1:
             page = 1
 
-        if warnings:
-            last_warning = warnings[0]
-            last_warning_time = datetime.datetime.fromtimestamp(
-                last_warning[2]
-            ).strftime("%d %B %Y")
+        if total:
+            last_warning_time = datetime.datetime.fromtimestamp(last_warning).strftime(
+                "%d %B %Y"
+            )
             embed = discord.Embed(
                 title="List of previously given warnings",
                 colour=0xD0021B,
-                description=f"{member.mention} has `{len(warnings)}` warnings.\n"
+                description=f"{member.mention} has `{total}` warnings.\n"
                 f"Their last warning was given on {last_warning_time}",
             )
             embed.set_thumbnail(
@@ -215,13 +313,13 @@ class Moderation(commands.Cog):
                 icon_url=member.avatar_url_as(format="png", static_format="png"),
             )
             embed.set_footer(text=f"Page {page} of {pages}")
-            for n, w in enumerate(
-                warnings[(page - 1) * 6 : page * 6], start=(page - 1) * 6 + 1
-            ):
-                author_id, reason, timestamp = w
+            warnings = await self.bot.database.get_warnings_page(
+                member, limit=6, offset=(page - 1) * 6
+            )
+            for warning_id, author_id, reason, timestamp in warnings:
                 date = datetime.datetime.fromtimestamp(timestamp)
                 embed.add_field(
-                    name=f"{n}. {date.strftime('%d %B %Y %H:%M')}",
+                    name=f"#{warning_id} · {date.strftime('%d %B %Y %H:%M')}",
                     value=f"Reason: {reason}\n"
                     f"Given by: {ctx.guild.get_member(author_id)}",
                     inline=True,
@@ -233,38 +331,49 @@ class Moderation(commands.Cog):
     @commands.command(aliases=["removewarn", "warnremove"])
     @commands.guild_only()
     @commands.check(is_mod)
-    async def removewarning(self, ctx, member: discord.Member, warning_id):
+    async def removewarning(
+        self,
+        ctx,
+        member: discord.Member,
+        warning_id,
+        moderator: discord.Member = None,
+    ):
         """Remove a warning given the warning ID. (See user warning list for warning IDs).
-        
-        To remove all warnings, replace the warning ID with the word "all\""""
-        warnings = await self.bot.database.get_warnings(member)
+
+        To remove all warnings, replace the warning ID with the word "all".
+        To remove the warnings given by a moderator, replace the warning ID with "by <moderator>"."""
         if not warning_id.isdigit():
             if warning_id == "all":
-                for w in warnings:
-                    timestamp = w[-1]
-                    await self.bot.database.remove_warning(member, timestamp)
+                removed = await self.bot.database.remove_all_warnings(member)
                 await ctx.send(
-                    f"✅ All warnings for {member.mention} have been removed."
+                    f"✅ All {removed} warnings for {member.mention} have been removed."
                 )
                 embed = discord.Embed(
                     colour=EMBED_ACCENT_COLOUR,
                     description=f"⚠️ {ctx.author.mention} removed all warnings from {member.mention}",
                 )
                 await self.log(embed)
+            elif warning_id == "by" and moderator is not None:
+                removed = await self.bot.database.remove_warnings_by_author(
+                    member, moderator
+                )
+                await ctx.send(
+                    f"✅ {removed} warnings given to {member.mention} by {moderator} have been removed."
+                )
+                embed = discord.Embed(
+                    colour=EMBED_ACCENT_COLOUR,
+                    description=f"⚠️ {ctx.author.mention} removed the warnings {moderator.mention} gave to {member.mention}",
+                )
+                await self.log(embed)
             else:
                 raise ValueError("Warning ID must be a number.")
         else:
             warning_id = int(warning_id)
-            if warning_id < 1:
-                await ctx.send(f"There is no warning with the ID {warning_id}")
-                return
-            try:
-                warning = warnings[warning_id - 1]
-            except IndexError:
+            removed = await self.bot.database.remove_warning(member, warning_id)
+            if removed is None:
                 await ctx.send(f"There is no warning with the ID {warning_id}")
             else:
-                author_id, reason, timestamp = warning
-                await self.bot.database.remove_warning(member, timestamp)
+                author_id, reason = removed
                 await ctx.send(
                     f"✅ The warning given to {member.mention} by {ctx.guild.get_member(author_id)} "
                     f'for reason: "{reason}" has been removed.'
@@ -351,6 +460,7 @@ class Moderation(commands.Cog):
         t = self.BAN if p_type == "banned" else self.MUTE
         if expiry_time >= 0:
             await self.bot.database.new_punishment(member, t, expiry_time)
+            self.queue_punishment(member.id, member.guild.id, t, expiry_time)
             await ctx.send(
                 f"✅ {member} has been {p_type} for {str(total_time)}. Reason: {reason}"
             )
@@ -500,12 +610,7 @@ class Moderation(commands.Cog):
         role = guild.get_role(int(self.bot.database.settings.get("mute_role_id")))
         if role in member.roles:
             await member.remove_roles(role)
-            await self.bot.database.conn.execute(
-                "DELETE FROM temporary_punishments WHERE member_id=$1 AND guild_id=$2 AND type=$3;",
-                member.id,
-                member.guild.id,
-                self.MUTE,
-            )
+            await self.bot.database.remove_punishments(member, self.MUTE)
             return True
         else:
             return False
@@ -522,13 +627,21 @@ class Moderation(commands.Cog):
 
         msg = await ctx.send("🔄 Setting up permissions...")
 
-        for channel in ctx.guild.channels:
-            if isinstance(channel, discord.TextChannel):
-                await channel.set_permissions(role, overwrite=text_overwrite)
+        plan = [
+            (channel, role, text_overwrite)
+            for channel in ctx.guild.channels
+            if isinstance(channel, discord.TextChannel)
+        ]
+        job = await sync_permissions(
+            plan, progress=edit_progress(msg, "Setting up permissions")
+        )
 
-        await self.bot.database.set_setting("guild_mute_role_id", str(ctx.guild.id))
-        await self.bot.database.set_setting("mute_role_id", str(role.id))
-        await msg.edit(content=f"✅ {role.mention} is now set as the mute role.")
+        await self.bot.database.set_settings(
+            {"guild_mute_role_id": str(ctx.guild.id), "mute_role_id": str(role.id)}
+        )
+        await msg.edit(
+            content=f"✅ {role.mention} is now set as the mute role. ({summarise_sync(plan, job)})"
+        )
 
     @commands.command()
     @commands.guild_only()
@@ -564,8 +677,9 @@ class Moderation(commands.Cog):
     @commands.check(is_admin)
     async def logchannel(self, ctx, channel: discord.TextChannel):
         """Set the channel in which logs are sent."""
-        await self.bot.database.set_setting("log_guild_id", str(channel.guild.id))
-        await self.bot.database.set_setting("log_channel_id", str(channel.id))
+        await self.bot.database.set_settings(
+            {"log_guild_id": str(channel.guild.id), "log_channel_id": str(channel.id)}
+        )
         await ctx.send(f"✅ {channel.mention} is now the log channel.")
 
     @commands.command()
@@ -573,8 +687,12 @@ class Moderation(commands.Cog):
     @commands.check(is_admin)
     async def repchannel(self, ctx, channel: discord.TextChannel):
         """Set the channel in which rep logs are sent."""
-        await self.bot.database.set_setting("replog_guild_id", str(channel.guild.id))
-        await self.bot.database.set_setting("replog_channel_id", str(channel.id))
+        await self.bot.database.set_settings(
+            {
+                "replog_guild_id": str(channel.guild.id),
+                "replog_channel_id": str(channel.id),
+            }
+        )
         await ctx.send(f"✅ {channel.mention} is now the reps log channel.")
 
     @commands.command()
@@ -592,16 +710,22 @@ class Moderation(commands.Cog):
 
         msg = await ctx.send("🔄 Setting up permissions...")
 
+        plan = []
         for channel in ctx.guild.channels:
             if isinstance(channel, discord.TextChannel):
                 if channel == jail_channel:
-                    await channel.set_permissions(jail_role, overwrite=jail_allow)
+                    plan.append((channel, jail_role, jail_allow))
                 else:
-                    await channel.set_permissions(jail_role, overwrite=jail_deny_text)
+                    plan.append((channel, jail_role, jail_deny_text))
             elif isinstance(channel, discord.VoiceChannel):
-                await channel.set_permissions(jail_role, overwrite=jail_deny_voice)
+                plan.append((channel, jail_role, jail_deny_voice))
+        job = await sync_permissions(
+            plan, progress=edit_progress(msg, "Setting up permissions")
+        )
 
-        await msg.edit(content=f"✅ The jail is now setup!")
+        await msg.edit(
+            content=f"✅ The jail is now setup! ({summarise_sync(plan, job)})"
+        )
 
     @commands.command(aliases=["nursery"])
     @commands.guild_only()
@@ -611,7 +735,7 @@ class Moderation(commands.Cog):
         if ctx.author.top_role <= member.top_role:
             await ctx.send("You cannot jail this user.")
             return
-                               
+
         role = self.bot.database.settings.get("jail_role_id")
         if not role:
             await ctx.send(
@@ -643,26 +767,88 @@ class Moderation(commands.Cog):
             await member.add_roles(*previous_roles)
         await ctx.send(f"👮 {member.mention} has been released from nursery!")
 
-    @tasks.loop(minutes=1, reconnect=True)
+    def queue_punishment(self, member_id, guild_id, punishment_type, expiry_date):
+        """Schedule a temporary punishment to be lifted when it expires."""
+        heapq.heappush(
+            self.punishment_queue, (expiry_date, member_id, guild_id, punishment_type)
+        )
+        self.punishment_added.set()
+
+    async def reload_punishments(self, member_id=None):
+        """Reload the punishment queue, e.g. after another process changed it."""
+        punishments = await self.bot.database.get_temporary_punishments()
+        self.punishment_queue = [
+            (p["expiry_date"], p["member_id"], p["guild_id"], p["type"])
+            for p in punishments
+        ]
+        heapq.heapify(self.punishment_queue)
+        self.punishment_added.set()
+
+    async def schedule_punishments(self):
+        """Lift temporary punishments as soon as they expire."""
+        await self.bot.wait_until_ready()
+        # Load the pending punishments at startup, and again whenever this
+        # process becomes the leader later on.
+        await self.reload_punishments()
+
+        while True:
+            if not self.bot.database.is_leader:
+                await self.bot.database.wait_for_leadership()
+                await self.reload_punishments()
+            self.punishment_added.clear()
+            if self.punishment_queue and self.punishment_queue[0][0] <= time.time():
+                expiry_date, member_id, guild_id, punishment_type = heapq.heappop(
+                    self.punishment_queue
+                )
+                try:
+                    # Only lift punishments which are still stored, as they may
+                    # have been lifted early or by the fallback check already.
+                    removed = await self.bot.database.remove_expired_punishment(
+                        member_id, guild_id, punishment_type, expiry_date
+                    )
+                    if removed:
+                        await self.lift_punishment(member_id, guild_id, punishment_type)
+                except Exception:
+                    self.logger.exception("Failed to lift an expired punishment")
+                continue
+
+            timeout = None
+            if self.punishment_queue:
+                timeout = self.punishment_queue[0][0] - time.time()
+            try:
+                await asyncio.wait_for(self.punishment_added.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def lift_punishment(self, member_id, guild_id, punishment_type):
+        """Lift a temporary punishment from a member."""
+        guild = self.bot.get_guild(guild_id)
+        if punishment_type == self.BAN:
+            try:
+                await guild.unban(discord.Object(id=member_id))
+            except discord.NotFound:
+                pass
+            self.bans.set(guild.id, member_id, None)
+        elif punishment_type == self.MUTE:
+            member = guild.get_member(member_id)
+            if member:
+                await self.unmute_member(member)
+
+    @tasks.loop(minutes=30, reconnect=True)
+    @leader_only
     async def check_expired_punishments(self):
+        """Fallback for punishments the scheduler missed, e.g. after a crash."""
         self.logger.debug("Checking for expired punishments")
         punishments = await self.bot.database.get_expired_punishments()
         if punishments:
             self.logger.debug("Punishments found!")
         for p in punishments:
             self.logger.debug(p)
-            member_id, guild_id, punishment_type = p
-            guild = self.bot.get_guild(guild_id)
-            if punishment_type == self.BAN:
-                bans = await guild.bans()
-                for b in bans:
-                    if b.user.id == member_id:
-                        await guild.unban(b.user)
-                        break
-            elif punishment_type == self.MUTE:
-                member = guild.get_member(member_id)
-                if member:
-                    await self.unmute_member(member)
+            await self.lift_punishment(*p)
+
+    @check_expired_punishments.before_loop
+    async def before_check_expired_punishments(self):
+        await self.bot.wait_until_ready()
 
     @commands.command()
     @commands.guild_only()
@@ -679,17 +865,20 @@ class Moderation(commands.Cog):
 
         embed = discord.Embed(colour=0xFF0000, title="Ongoing Punishments")
         embed.set_footer(text=f"Page {page} of {pages}")
-        for p in punishments[(page - 1) * 6 : page * 6]:
+        page_punishments = punishments[(page - 1) * 6 : page * 6]
+        banned_users = await self.bans.get_bans(
+            ctx.guild,
+            [
+                p["member_id"]
+                for p in page_punishments
+                if p["type"] == self.BAN and not ctx.guild.get_member(p["member_id"])
+            ],
+        )
+        for p in page_punishments:
             member = ctx.guild.get_member(p["member_id"])
             if not member and p["type"] == self.BAN:
-                bans = await ctx.guild.bans()
-                for b in bans:
-                    if b.user.id == p["member_id"]:
-                        member = b.user
-                        break
-                else:
-                    continue
-            elif not member:
+                member = banned_users.get(p["member_id"])
+            if not member:
                 continue
             delta = (
                 datetime.datetime.fromtimestamp(p["expiry_date"])
@@ -702,6 +891,14 @@ class Moderation(commands.Cog):
             )
         await ctx.send(embed=embed)
 
+    @commands.Cog.listener()
+    async def on_member_ban(self, guild, user):
+        self.bans.set(guild.id, user.id, user)
+
+    @commands.Cog.listener()
+    async def on_member_unban(self, guild, user):
+        self.bans.set(guild.id, user.id, None)
+
     async def log(self, embed):
         """Log messages if the log channel is enabled."""
         guild_id = self.bot.database.settings.get("log_guild_id")
@@ -1,96 +1,561 @@
 import asyncio
 import asyncpg
-from settings import DATABASE_URL
+import json
+import logging
+import uuid
+import zlib
+from contextlib import asynccontextmanager
+from settings import (
+    DATABASE_URL,
+    DATABASE_POOL_MIN_SIZE,
+    DATABASE_POOL_MAX_SIZE,
+    DATABASE_ACQUIRE_TIMEOUT,
+    SETTINGS_STORAGE,
+)
+from storage import Storage
 import time
 import os
 
 
-class Database:
-    """A database access object for interacting with the bot database."""
-
-    def __init__(self):
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(self.connect_to_database())
+# Schema migrations as (version, description, statements). Each migration is
+# applied once, in order, inside its own transaction.
+MIGRATIONS = [
+    (
+        1,
+        "Add indexes and the unique constraints used by upserts",
+        [
+            "CREATE INDEX IF NOT EXISTS warnings_member_id_timestamp_idx "
+            "ON warnings (member_id, timestamp);",
+            "CREATE INDEX IF NOT EXISTS temporary_punishments_expiry_date_idx "
+            "ON temporary_punishments (expiry_date);",
+            "DELETE FROM helper_roles a USING helper_roles b "
+            "WHERE a.ctid < b.ctid AND a.guild_id = b.guild_id "
+            "AND a.channel_id = b.channel_id AND a.role_id = b.role_id;",
+            "CREATE UNIQUE INDEX IF NOT EXISTS helper_roles_guild_id_channel_id_role_id_idx "
+            "ON helper_roles (guild_id, channel_id, role_id);",
+            "DELETE FROM assign_role_reactions a USING assign_role_reactions b "
+            "WHERE a.ctid < b.ctid AND a.message_id = b.message_id AND a.emoji = b.emoji;",
+            "CREATE UNIQUE INDEX IF NOT EXISTS assign_role_reactions_message_id_emoji_idx "
+            "ON assign_role_reactions (message_id, emoji);",
+        ],
+    ),
+    (
+        2,
+        "Give warnings a serial primary key",
+        [
+            "ALTER TABLE warnings ADD COLUMN IF NOT EXISTS warning_id SERIAL PRIMARY KEY;"
+        ],
+    ),
+    (
+        3,
+        "Add a table for compressed warning archives",
+        [
+            "CREATE TABLE IF NOT EXISTS warning_archives "
+            "(archive_id SERIAL PRIMARY KEY, archived_at BIGINT, warnings INTEGER, data BYTEA);"
+        ],
+    ),
+    (
+        4,
+        "Add a single-row JSONB settings document",
+        [
+            "CREATE TABLE IF NOT EXISTS settings_document "
+            "(id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id), data JSONB NOT NULL);"
+        ],
+    ),
+    (
+        5,
+        "Notify listening processes when cached tables change",
+        [
+            "CREATE OR REPLACE FUNCTION notify_cache_change() RETURNS trigger AS $$ "
+            "DECLARE changed JSONB; "
+            "BEGIN "
+            "IF TG_OP = 'DELETE' THEN changed := to_jsonb(OLD); "
+            "ELSE changed := to_jsonb(NEW); END IF; "
+            "PERFORM pg_notify('cache_changes', json_build_object("
+            "'table', TG_TABLE_NAME, 'key', changed ->> TG_ARGV[0], "
+            "'origin', current_setting('application_name'))::text); "
+            "RETURN NULL; "
+            "END; $$ LANGUAGE plpgsql;",
+            "DROP TRIGGER IF EXISTS settings_cache_change ON settings;",
+            "CREATE TRIGGER settings_cache_change AFTER INSERT OR UPDATE OR DELETE ON settings "
+            "FOR EACH ROW EXECUTE PROCEDURE notify_cache_change('key');",
+            "DROP TRIGGER IF EXISTS settings_document_cache_change ON settings_document;",
+            "CREATE TRIGGER settings_document_cache_change AFTER INSERT OR UPDATE OR DELETE ON settings_document "
+            "FOR EACH ROW EXECUTE PROCEDURE notify_cache_change('id');",
+            "DROP TRIGGER IF EXISTS assign_role_reactions_cache_change ON assign_role_reactions;",
+            "CREATE TRIGGER assign_role_reactions_cache_change AFTER INSERT OR UPDATE OR DELETE ON assign_role_reactions "
+            "FOR EACH ROW EXECUTE PROCEDURE notify_cache_change('message_id');",
+            "DROP TRIGGER IF EXISTS helper_roles_cache_change ON helper_roles;",
+            "CREATE TRIGGER helper_roles_cache_change AFTER INSERT OR UPDATE OR DELETE ON helper_roles "
+            "FOR EACH ROW EXECUTE PROCEDURE notify_cache_change('channel_id');",
+            "DROP TRIGGER IF EXISTS tags_cache_change ON tags;",
+            "CREATE TRIGGER tags_cache_change AFTER INSERT OR UPDATE OR DELETE ON tags "
+            "FOR EACH ROW EXECUTE PROCEDURE notify_cache_change('key');",
+            "DROP TRIGGER IF EXISTS join_roles_cache_change ON join_roles;",
+            "CREATE TRIGGER join_roles_cache_change AFTER INSERT OR UPDATE OR DELETE ON join_roles "
+            "FOR EACH ROW EXECUTE PROCEDURE notify_cache_change('role_id');",
+            "DROP TRIGGER IF EXISTS temporary_punishments_cache_change ON temporary_punishments;",
+            "CREATE TRIGGER temporary_punishments_cache_change AFTER INSERT OR UPDATE OR DELETE ON temporary_punishments "
+            "FOR EACH ROW EXECUTE PROCEDURE notify_cache_change('member_id');",
+        ],
+    ),
+]
+
+# Advisory lock held while migrating so that only one process migrates at a time.
+MIGRATION_LOCK_ID = 0x4D494752
+
+# Advisory lock held by the leader process, which runs the singleton background tasks.
+LEADER_LOCK_ID = 0x57415453
+LEADER_RETRY_INTERVAL = 15
+LISTENER_CHECK_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
+
+def log_task_failure(task):
+    """Log the exception of a background task which nothing awaits."""
+    if not task.cancelled() and task.exception():
+        logger.error("Background task failed", exc_info=task.exception())
+
+
+class Database(Storage):
+    """A storage backend for the bot database in PostgreSQL."""
+
+    def __init__(
+        self,
+        min_size=DATABASE_POOL_MIN_SIZE,
+        max_size=DATABASE_POOL_MAX_SIZE,
+        acquire_timeout=DATABASE_ACQUIRE_TIMEOUT,
+        settings_storage=SETTINGS_STORAGE,
+    ):
+        super().__init__(settings_storage)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.in_use = 0
+        self.max_in_use = 0
+        self.waiting = 0
+        self.acquires = 0
+        self.acquire_timeouts = 0
+        self.total_acquire_time = 0
+        self.max_acquire_time = 0
+        self.exact_table_stats = None
+        self.exact_table_stats_expiry = 0
+        self.instance_id = f"watson-{uuid.uuid4().hex[:8]}"
+        self.pool = None
+        self.listener = None
+        self.election = None
+        self.closing = False
 
     async def connect_to_database(self):
-        self.conn = await asyncpg.connect(DATABASE_URL + "?sslmode=require")
-        self.settings = await self.load_settings()
+        self.pool = await asyncpg.create_pool(
+            DATABASE_URL + "?sslmode=require",
+            min_size=self.min_size,
+            max_size=self.max_size,
+            server_settings={"application_name": self.instance_id},
+        )
+        await asyncio.gather(self.prepare_schema(), self.listen_for_changes())
+        await self.load_caches()
+        self.ready.set()
+
+    async def close(self):
+        """Close the listener connection and the connection pool."""
+        self.closing = True
+        if self.election:
+            self.election.cancel()
+        if self.listener:
+            await self.listener.close()
+        if self.pool:
+            await self.pool.close()
+
+    async def prepare_schema(self):
+        """Create the tables and apply any outstanding migrations."""
         await self.init_tables()
+        await self.migrate()
+
+    async def listen_for_changes(self):
+        """Listen for changes made to cached tables by other processes."""
+        listener = await asyncpg.connect(
+            DATABASE_URL + "?sslmode=require",
+            server_settings={"application_name": self.instance_id},
+        )
+        try:
+            await listener.add_listener("cache_changes", self.on_cache_change)
+        except Exception:
+            listener.terminate()
+            raise
+        self.listener = listener
+        self.election = asyncio.ensure_future(self.elect_leader())
+        self.election.add_done_callback(log_task_failure)
+
+    async def elect_leader(self):
+        """Try to become the leader process by holding an advisory lock on the
+        listener connection. The lock is released if the connection drops.
+
+        The connection is checked on every attempt, and by the leader, so that
+        a dropped listener is noticed and reconnected."""
+        while True:
+            try:
+                if self.is_leader:
+                    await asyncio.wait_for(
+                        self.listener.fetchval("SELECT 1;"), LISTENER_CHECK_TIMEOUT
+                    )
+                else:
+                    acquired = await asyncio.wait_for(
+                        self.listener.fetchval(
+                            "SELECT pg_try_advisory_lock($1);", LEADER_LOCK_ID
+                        ),
+                        LISTENER_CHECK_TIMEOUT,
+                    )
+                    if acquired:
+                        logger.info("This process is now the leader")
+                        self.is_leader = True
+                        self.leadership.set()
+            except Exception as e:
+                if not self.closing:
+                    self.on_listener_lost(e)
+                return
+            await asyncio.sleep(LEADER_RETRY_INTERVAL)
+
+    def on_listener_lost(self, error):
+        logger.warning(f"Lost the change listener connection ({error!r}), reconnecting")
+        self.listener.terminate()
+        if self.is_leader:
+            logger.warning("This process is no longer the leader")
+        self.is_leader = False
+        self.leadership.clear()
+        asyncio.ensure_future(self.reconnect_listener()).add_done_callback(
+            log_task_failure
+        )
+
+    async def reconnect_listener(self):
+        connected = False
+        delay = 1
+        while not self.closing:
+            await asyncio.sleep(delay)
+            try:
+                if not connected:
+                    await self.listen_for_changes()
+                    connected = True
+                # Changes may have been missed while disconnected.
+                await self.load_caches()
+                for table, callbacks in self.change_listeners.items():
+                    for callback in callbacks:
+                        await callback(None)
+                return
+            except Exception:
+                delay = min(delay * 2, 60)
+                logger.exception(
+                    f"Failed to reconnect the change listener, retrying in {delay}s"
+                )
+
+    def on_cache_change(self, connection, pid, channel, payload):
+        change = json.loads(payload)
+        if change["origin"] == self.instance_id:
+            return
+        asyncio.ensure_future(
+            self.apply_cache_change(change["table"], change["key"])
+        ).add_done_callback(log_task_failure)
+
+    async def apply_cache_change(self, table, key):
+        """Bring the caches up to date with a change made elsewhere."""
+        if table == "settings" and self.settings_storage == "rows":
+            value = await self.fetchval("SELECT value FROM settings WHERE key=$1;", key)
+            if value is None:
+                self.settings.pop(key, None)
+            else:
+                self.settings[key] = value
+        elif table == "settings_document" and self.settings_storage == "document":
+            settings = await self.load_settings()
+            self.settings.clear()
+            self.settings.update(settings)
+        elif table == "assign_role_reactions":
+            message_id = int(key)
+            results = await self.fetch(
+                "SELECT emoji, role_id, nick_addition FROM assign_role_reactions "
+                "WHERE message_id=$1;",
+                message_id,
+            )
+            if results:
+                self.role_reactions[message_id] = {
+                    r["emoji"]: (r["role_id"], r["nick_addition"]) for r in results
+                }
+            else:
+                self.role_reactions.pop(message_id, None)
+        elif table == "helper_roles":
+            self.helper_roles.pop(int(key), None)
+
+        for callback in self.change_listeners.get(table, []):
+            await callback(key)
+
+    @asynccontextmanager
+    async def acquire(self, timeout=None):
+        """Acquire a connection from the pool, recording how long it took."""
+        if timeout is None:
+            timeout = self.acquire_timeout
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            conn = await self.pool.acquire(timeout=timeout)
+        except asyncio.TimeoutError:
+            self.acquire_timeouts += 1
+            raise
+        finally:
+            self.waiting -= 1
+        elapsed = time.perf_counter() - start
+        self.acquires += 1
+        self.total_acquire_time += elapsed
+        self.max_acquire_time = max(self.max_acquire_time, elapsed)
+        self.in_use += 1
+        self.max_in_use = max(self.max_in_use, self.in_use)
+        try:
+            yield conn
+        finally:
+            self.in_use -= 1
+            await self.pool.release(conn)
+
+    async def run(self, call, query, *args):
+        """Run a query with a connection method such as `conn.fetch`, recording
+        it in the query metrics."""
+        with self.metrics.measure(query, args) as timer:
+            result = await call(query, *args)
+            if isinstance(result, list):
+                timer.rows = len(result)
+            elif isinstance(result, asyncpg.Record):
+                timer.rows = 1
+        return result
+
+    async def execute(self, query, *args, timeout=None):
+        """Execute a statement on a pooled connection."""
+        async with self.acquire(timeout) as conn:
+            return await self.run(conn.execute, query, *args)
+
+    async def fetch(self, query, *args, timeout=None):
+        """Fetch all rows for a query on a pooled connection."""
+        async with self.acquire(timeout) as conn:
+            return await self.run(conn.fetch, query, *args)
+
+    async def fetchrow(self, query, *args, timeout=None):
+        """Fetch the first row for a query on a pooled connection."""
+        async with self.acquire(timeout) as conn:
+            return await self.run(conn.fetchrow, query, *args)
+
+    async def fetchval(self, query, *args, timeout=None):
+        """Fetch a single value for a query on a pooled connection."""
+        async with self.acquire(timeout) as conn:
+            return await self.run(conn.fetchval, query, *args)
+
+    def get_pool_stats(self):
+        """Retrieve statistics about the connection pool.
+
+        The pool only opens connections beyond its minimum size when they are
+        needed, so its size is estimated from the most connections in use at
+        once, as the pinned asyncpg has no size accessors."""
+        size = max(self.min_size, self.max_in_use)
+        return {
+            "size": size,
+            "idle": size - self.in_use,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "in_use": self.in_use,
+            "waiting": self.waiting,
+            "acquires": self.acquires,
+            "timeouts": self.acquire_timeouts,
+            "average_acquire_time": (
+                self.total_acquire_time / self.acquires if self.acquires else 0
+            ),
+            "max_acquire_time": self.max_acquire_time,
+        }
 
     async def init_tables(self):
-        """Intialise the database tables."""
-        await self.conn.execute(
+        """Intialise the database tables.
+
+        The statements are sent as one script, which Postgres runs as a single
+        implicit transaction in one round trip."""
+        await self.execute(
             "CREATE TABLE IF NOT EXISTS reputation_points "
             "(member_id BIGINT PRIMARY KEY, points INTEGER);"
-        )
-        await self.conn.execute(
             "CREATE TABLE IF NOT EXISTS warnings "
             "(member_id BIGINT, author BIGINT, reason TEXT, timestamp BIGINT);"
-        )
-        await self.conn.execute(
             "CREATE TABLE IF NOT EXISTS temporary_punishments "
             "(member_id BIGINT, guild_id BIGINT, type CHAR(1), expiry_date BIGINT);"
-        )
-        await self.conn.execute(
             "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);"
-        )
-        await self.conn.execute(
             "CREATE TABLE IF NOT EXISTS helper_roles (guild_id BIGINT, channel_id BIGINT, role_id BIGINT);"
-        )
-        await self.conn.execute(
             "CREATE TABLE IF NOT EXISTS assign_role_reactions "
             "(message_id BIGINT, emoji TEXT, role_id BIGINT, nick_addition TEXT);"
-        )
-        await self.conn.execute(
             "CREATE TABLE IF NOT EXISTS demographic_roles "
             "(role_id BIGINT PRIMARY KEY);"
-        )
-        await self.conn.execute(
             "CREATE TABLE IF NOT EXISTS tags (key TEXT PRIMARY KEY, value TEXT);"
-        )
-        await self.conn.execute(
             "CREATE TABLE IF NOT EXISTS jail_members (member_id BIGINT PRIMARY KEY, roles TEXT);"
-        )
-        await self.conn.execute(
             "CREATE TABLE IF NOT EXISTS join_roles (role_id BIGINT PRIMARY KEY);"
-        )
-        await self.conn.execute(
             "CREATE TABLE IF NOT EXISTS corona_tweets (tweet_id BIGINT PRIMARY KEY);"
+            "CREATE TABLE IF NOT EXISTS schema_version "
+            "(version INTEGER PRIMARY KEY, description TEXT, applied_at BIGINT);"
         )
 
+    async def migrate(self):
+        """Apply any schema migrations which have not been applied yet."""
+        async with self.acquire() as conn:
+            current = await self.run(
+                conn.fetchval, "SELECT COALESCE(MAX(version), 0) FROM schema_version;"
+            )
+            for version, description, statements in MIGRATIONS:
+                if version <= current:
+                    continue
+                async with conn.transaction():
+                    await self.run(
+                        conn.execute,
+                        "SELECT pg_advisory_xact_lock($1);",
+                        MIGRATION_LOCK_ID,
+                    )
+                    applied = await self.run(
+                        conn.fetchval,
+                        "SELECT 1 FROM schema_version WHERE version=$1;",
+                        version,
+                    )
+                    if applied:
+                        continue
+                    for statement in statements:
+                        await self.run(conn.execute, statement)
+                    await self.run(
+                        conn.execute,
+                        "INSERT INTO schema_version (version, description, applied_at) "
+                        "VALUES ($1, $2, $3);",
+                        version,
+                        description,
+                        int(time.time()),
+                    )
+
+    async def get_schema_version(self):
+        """Retrieve the latest applied schema migration."""
+        return await self.fetchval(
+            "SELECT COALESCE(MAX(version), 0) FROM schema_version;"
+        )
+
+    async def get_index_usage(self):
+        """Retrieve how often each index and sequential scan has been used."""
+        results = await self.fetch(
+            "SELECT t.relname AS table_name, t.seq_scan, i.indexrelname AS index_name, i.idx_scan "
+            "FROM pg_stat_user_tables t "
+            "LEFT JOIN pg_stat_user_indexes i ON i.relid = t.relid "
+            "ORDER BY t.relname, i.indexrelname;"
+        )
+        return [
+            (r["table_name"], r["seq_scan"], r["index_name"], r["idx_scan"])
+            for r in results
+        ]
+
     async def new_tweet(self, tweet):
         """Check if a tweet has been seen before."""
-        result = await self.conn.fetchrow(
+        result = await self.fetchrow(
             "SELECT * FROM corona_tweets WHERE tweet_id=$1;", tweet.id
         )
         if result:
             return True
         else:
-            await self.conn.execute(
+            await self.execute(
                 "INSERT INTO corona_tweets (tweet_id) VALUES ($1);", tweet.id
             )
             return False
 
+    async def prune_tweets(self, keep, dry_run=False):
+        """Remove all but the latest X tweets, returning how many were removed."""
+        if dry_run:
+            return await self.fetchval(
+                "SELECT GREATEST(COUNT(*) - $1, 0) FROM corona_tweets;", keep
+            )
+        result = await self.execute(
+            "DELETE FROM corona_tweets WHERE tweet_id NOT IN "
+            "(SELECT tweet_id FROM corona_tweets ORDER BY tweet_id DESC LIMIT $1);",
+            keep,
+        )
+        return int(result.split()[-1])
+
+    async def archive_warnings(self, before, archive_dir=None, dry_run=False):
+        """Move the warnings given before a timestamp into a compressed archive,
+        returning how many were archived.
+
+        The archive is stored as a single row in warning_archives, or written to
+        a file in `archive_dir` if one is given."""
+        if dry_run:
+            return await self.fetchval(
+                "SELECT COUNT(*) FROM warnings WHERE timestamp < $1;",
+                round(before * 100),
+            )
+
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                results = await self.run(
+                    conn.fetch,
+                    "DELETE FROM warnings WHERE timestamp < $1 "
+                    "RETURNING warning_id, member_id, author, reason, timestamp;",
+                    round(before * 100),
+                )
+                if not results:
+                    return 0
+                archived_at = int(time.time())
+                data = zlib.compress(json.dumps([dict(r) for r in results]).encode())
+                if archive_dir:
+                    path = os.path.join(archive_dir, f"warnings-{archived_at}.json.z")
+                    with open(path, "wb") as f:
+                        f.write(data)
+                else:
+                    await self.run(
+                        conn.execute,
+                        "INSERT INTO warning_archives (archived_at, warnings, data) "
+                        "VALUES ($1, $2, $3);",
+                        archived_at,
+                        len(results),
+                        data,
+                    )
+        return len(results)
+
     async def get_tables(self):
         """Retrieve all table names."""
-        results = await self.conn.fetch(
+        results = await self.fetch(
             "SELECT * FROM information_schema.tables WHERE table_schema = 'public';"
         )
         return [r["table_name"] for r in results]
 
-    async def get_total_rows(self):
-        """Retrieve the total rows used up."""
-        tables = await self.get_tables()
-        amount = 0
-        for table in tables:
-            result = await self.conn.fetchrow(f"SELECT COUNT(*) FROM {table};")
-            amount += result["count"]
-        return amount
+    async def get_table_stats(self, exact=False):
+        """Retrieve the row count and on-disk size of every table.
+
+        By default row counts are estimated from the planner statistics in a
+        single catalog query. Exact counts are taken in one UNION query and
+        cached for 30 seconds."""
+        if exact and self.exact_table_stats_expiry > time.monotonic():
+            return self.exact_table_stats
+
+        results = await self.fetch(
+            "SELECT c.relname AS table_name, "
+            "COALESCE(s.n_live_tup, GREATEST(c.reltuples, 0))::bigint AS rows, "
+            "pg_total_relation_size(c.oid) AS size "
+            "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid "
+            "WHERE n.nspname = 'public' AND c.relkind = 'r';"
+        )
+        stats = {
+            r["table_name"]: {"rows": r["rows"], "size": r["size"]} for r in results
+        }
+        if not exact or not stats:
+            return stats
+
+        counts = await self.fetch(
+            " UNION ALL ".join(
+                f"SELECT '{table}' AS table_name, COUNT(*) AS rows FROM \"{table}\""
+                for table in stats
+            )
+        )
+        for r in counts:
+            stats[r["table_name"]]["rows"] = r["rows"]
+        self.exact_table_stats = stats
+        self.exact_table_stats_expiry = time.monotonic() + 30
+        return stats
 
     async def add_jail_member(self, member, roles):
         """Add a member to jail."""
         roles_string = ";".join([str(r.id) for r in roles[1:]])
-        await self.conn.execute(
+        await self.execute(
             "INSERT INTO jail_members (member_id, roles) VALUES ($1, $2);",
             member.id,
             roles_string,
@@ -98,73 +563,92 @@ class Database:
 
     async def remove_jail_member(self, member):
         """Remove a member from jail and get their previous roles."""
-        record = await self.conn.fetchrow(
+        record = await self.fetchrow(
             "SELECT * FROM jail_members WHERE member_id=$1;", member.id
         )
         role_ids = [int(rid) for rid in record["roles"].split(";")]
-        await self.conn.execute(
-            "DELETE FROM jail_members WHERE member_id=$1;", member.id
-        )
+        await self.execute("DELETE FROM jail_members WHERE member_id=$1;", member.id)
         return role_ids
 
     async def get_tag(self, tag):
         """Get a definition for a tag."""
-        result = await self.conn.fetchrow("SELECT value FROM tags WHERE key=$1", tag)
+        result = await self.fetchrow("SELECT value FROM tags WHERE key=$1", tag)
         if result:
             return result["value"]
 
     async def add_tag(self, tag, definition):
         """Add a tag to the database."""
-        await self.conn.execute(
+        await self.execute(
             "INSERT INTO tags (key, value) VALUES ($1, $2);", tag, definition
         )
 
     async def remove_tag(self, tag):
         """Remvoe a tag from the database."""
-        await self.conn.execute("DELETE FROM tags WHERE key=$1", tag)
+        await self.execute("DELETE FROM tags WHERE key=$1", tag)
 
     async def load_settings(self):
         """Load settings from database."""
-        results = await self.conn.fetch("SELECT * FROM settings;")
+        if self.settings_storage == "document":
+            data = await self.fetchval("SELECT data FROM settings_document;")
+            if data is None:
+                data = await self.convert_settings_to_document()
+            return json.loads(data)
+        results = await self.fetch("SELECT * FROM settings;")
         return {r["key"]: r["value"] for r in results}
 
-    async def set_setting(self, key, value):
-        """Set a setting value."""
-        if key in self.settings:
-            await self.conn.execute(
-                "UPDATE settings SET value=$1 WHERE key=$2;", value, key
+    async def convert_settings_to_document(self):
+        """Move the settings rows into the settings document."""
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                data = await self.run(
+                    conn.fetchval,
+                    "INSERT INTO settings_document (id, data) "
+                    "SELECT TRUE, COALESCE(jsonb_object_agg(key, value), '{}'::jsonb) FROM settings "
+                    "ON CONFLICT (id) DO UPDATE SET data = settings_document.data || EXCLUDED.data "
+                    "RETURNING data;",
+                )
+                await self.run(conn.execute, "DELETE FROM settings;")
+        return data
+
+    async def set_settings(self, settings):
+        """Set several setting values at once."""
+        if self.settings_storage == "document":
+            await self.execute(
+                "INSERT INTO settings_document (id, data) VALUES (TRUE, $1::jsonb) "
+                "ON CONFLICT (id) DO UPDATE SET data = settings_document.data || EXCLUDED.data;",
+                json.dumps(settings),
             )
         else:
-            await self.conn.execute(
-                "INSERT INTO settings (key, value) VALUES ($1, $2);", key, value
+            await self.execute(
+                "INSERT INTO settings (key, value) "
+                "SELECT * FROM unnest($1::text[], $2::text[]) "
+                "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;",
+                list(settings.keys()),
+                list(settings.values()),
             )
-        self.settings[key] = value
+        self.settings.update(settings)
 
     async def add_demographic_role(self, role):
-        await self.conn.execute(
+        await self.execute(
             "INSERT INTO demographic_roles (role_id) VALUES ($1);", role.id
         )
 
     async def remove_demographic_role(self, role):
-        await self.conn.execute(
-            "DELETE FROM demographic_roles WHERE role_id=$1", role.id
-        )
+        await self.execute("DELETE FROM demographic_roles WHERE role_id=$1", role.id)
 
     async def get_demographic_roles(self):
-        result = await self.conn.fetch("SELECT role_id FROM demographic_roles;")
+        result = await self.fetch("SELECT role_id FROM demographic_roles;")
         if result:
             return [r["role_id"] for r in result]
 
     async def add_join_role(self, role):
-        await self.conn.execute(
-            "INSERT INTO join_roles (role_id) VALUES ($1);", role.id
-        )
+        await self.execute("INSERT INTO join_roles (role_id) VALUES ($1);", role.id)
 
     async def remove_join_role(self, role):
-        await self.conn.execute("DELETE FROM join_roles WHERE role_id=$1", role.id)
+        await self.execute("DELETE FROM join_roles WHERE role_id=$1", role.id)
 
     async def get_join_roles(self):
-        result = await self.conn.fetch("SELECT role_id FROM join_roles;")
+        result = await self.fetch("SELECT role_id FROM join_roles;")
         if result:
             return [r["role_id"] for r in result]
         return []
@@ -174,63 +658,105 @@ class Database:
         helper_roles = await self.get_helper_roles(channel)
         if role.id in helper_roles:
             return
-        await self.conn.execute(
-            "INSERT INTO helper_roles (guild_id, channel_id, role_id) VALUES ($1, $2, $3);",
+        await self.execute(
+            "INSERT INTO helper_roles (guild_id, channel_id, role_id) VALUES ($1, $2, $3) "
+            "ON CONFLICT DO NOTHING;",
             channel.guild.id,
             channel.id,
             role.id,
         )
+        self.helper_roles[channel.id].add(role.id)
 
     async def get_helper_roles(self, channel):
         """Get the helper role for a channel."""
-        results = await self.conn.fetch(
-            "SELECT role_id FROM helper_roles WHERE guild_id=$1 AND channel_id=$2",
-            channel.guild.id,
-            channel.id,
-        )
-        return [r["role_id"] for r in results]
+        if channel.id in self.helper_roles:
+            self.helper_role_hits += 1
+        else:
+            self.helper_role_misses += 1
+            results = await self.fetch(
+                "SELECT role_id FROM helper_roles WHERE guild_id=$1 AND channel_id=$2",
+                channel.guild.id,
+                channel.id,
+            )
+            self.helper_roles[channel.id] = {r["role_id"] for r in results}
+        return list(self.helper_roles[channel.id])
+
+    async def get_all_helper_roles(self):
+        """Get the helper roles for every channel, refreshing the cache."""
+        results = await self.fetch("SELECT channel_id, role_id FROM helper_roles;")
+        helper_roles = {}
+        for r in results:
+            helper_roles.setdefault(r["channel_id"], set()).add(r["role_id"])
+        self.helper_roles = helper_roles
+        return {channel_id: set(roles) for channel_id, roles in helper_roles.items()}
+
+    async def load_role_reactions(self):
+        """Load the role reactions, indexed by message ID and then by emoji."""
+        results = await self.fetch(
+            "SELECT message_id, emoji, role_id, nick_addition FROM assign_role_reactions;"
+        )
+        role_reactions = {}
+        for r in results:
+            role_reactions.setdefault(r["message_id"], {})[r["emoji"]] = (
+                r["role_id"],
+                r["nick_addition"],
+            )
+        return role_reactions
 
     async def add_role_reaction(self, message_id, emoji, role, nick):
         """Add a role reaction."""
-        await self.conn.execute(
+        await self.execute(
             "INSERT INTO assign_role_reactions (message_id, emoji, role_id, nick_addition) "
-            "VALUES ($1, $2, $3, $4);",
+            "VALUES ($1, $2, $3, $4) ON CONFLICT (message_id, emoji) "
+            "DO UPDATE SET role_id = EXCLUDED.role_id, nick_addition = EXCLUDED.nick_addition;",
             message_id,
             str(emoji),
             role.id,
             nick,
         )
+        self.role_reactions.setdefault(message_id, {})[str(emoji)] = (role.id, nick)
 
     async def remove_role_reaction(self, message_id, emoji):
         """Remove a role reaction."""
-        await self.conn.execute(
+        await self.execute(
             "DELETE FROM assign_role_reactions WHERE message_id=$1 AND emoji=$2;",
             message_id,
             str(emoji),
         )
+        reactions = self.role_reactions.get(message_id, {})
+        reactions.pop(str(emoji), None)
+        if not reactions:
+            self.role_reactions.pop(message_id, None)
 
-    async def check_reaction(self, message_id, emoji):
-        """Check roles for a reaction to a message."""
-        result = await self.conn.fetchrow(
-            "SELECT role_id, nick_addition FROM assign_role_reactions WHERE message_id=$1 AND emoji=$2;",
-            message_id,
-            str(emoji),
-        )
-        if result:
-            return result["role_id"], result["nick_addition"]
-
-    async def remove_helper_role(self, channel, role_id):
-        """Remove a helper role from a channel."""
-        await self.conn.execute(
-            "DELETE FROM helper_roles WHERE guild_id=$1 AND channel_id=$2 AND role_id=$3;",
+    async def remove_helper_roles(self, channel, role_ids):
+        """Remove several helper roles from a channel in one statement."""
+        await self.execute(
+            "DELETE FROM helper_roles WHERE guild_id=$1 AND channel_id=$2 AND role_id = ANY($3::bigint[]);",
             channel.guild.id,
             channel.id,
-            role_id,
+            list(role_ids),
+        )
+        self.helper_roles.get(channel.id, set()).difference_update(role_ids)
+
+    async def prune_helper_roles(self, channel_ids=(), role_ids=()):
+        """Remove deleted channels and roles from the helper roles in one statement."""
+        channel_ids = set(channel_ids)
+        role_ids = set(role_ids)
+        if not channel_ids and not role_ids:
+            return
+        await self.execute(
+            "DELETE FROM helper_roles WHERE channel_id = ANY($1::bigint[]) OR role_id = ANY($2::bigint[]);",
+            list(channel_ids),
+            list(role_ids),
         )
+        for channel_id in channel_ids:
+            self.helper_roles.pop(channel_id, None)
+        for roles in self.helper_roles.values():
+            roles.difference_update(role_ids)
 
     async def new_punishment(self, member, punishment_type, expire_date):
         """Add temporary punishment to the database."""
-        await self.conn.execute(
+        await self.execute(
             "INSERT INTO temporary_punishments (member_id, guild_id, type, expiry_date) "
             "VALUES ($1, $2, $3, $4);",
             member.id,
@@ -241,20 +767,40 @@ class Database:
 
     async def get_expired_punishments(self):
         """Retrieve any expired punishments."""
-        time_now = time.time()
-        expired = await self.conn.fetch(
-            "SELECT member_id, guild_id, type FROM temporary_punishments WHERE expiry_date < $1;",
-            time_now,
-        )
-        if expired:
-            await self.conn.execute(
-                "DELETE FROM temporary_punishments WHERE expiry_date < $1;", time_now
-            )
+        expired = await self.fetch(
+            "DELETE FROM temporary_punishments WHERE expiry_date < $1 "
+            "RETURNING member_id, guild_id, type;",
+            time.time(),
+        )
         return [(e["member_id"], e["guild_id"], e["type"]) for e in expired]
 
+    async def remove_expired_punishment(
+        self, member_id, guild_id, punishment_type, expire_date
+    ):
+        """Remove a temporary punishment before lifting it, returning how many
+        were removed, which is 0 if it has already been lifted."""
+        result = await self.execute(
+            "DELETE FROM temporary_punishments "
+            "WHERE member_id=$1 AND guild_id=$2 AND type=$3 AND expiry_date <= $4;",
+            member_id,
+            guild_id,
+            punishment_type,
+            expire_date,
+        )
+        return int(result.split()[-1])
+
+    async def remove_punishments(self, member, punishment_type):
+        """Remove every temporary punishment of a type from a member."""
+        await self.execute(
+            "DELETE FROM temporary_punishments WHERE member_id=$1 AND guild_id=$2 AND type=$3;",
+            member.id,
+            member.guild.id,
+            punishment_type,
+        )
+
     async def get_temporary_punishments(self):
         """Get all active punishments"""
-        result = await self.conn.fetch(
+        result = await self.fetch(
             "SELECT * FROM temporary_punishments ORDER BY expiry_date;"
         )
         return result  # [(r["member_id"], r["type"], r["expiry_date"]) for r in result]
@@ -262,7 +808,7 @@ class Database:
     async def add_warning(self, member, author, reason):
         """Add a warning to a member."""
         t = time.time() * 100
-        await self.conn.execute(
+        await self.execute(
             "INSERT INTO warnings (member_id, author, reason, timestamp) "
             "VALUES ($1, $2, $3, $4);",
             member.id,
@@ -271,72 +817,154 @@ class Database:
             t,
         )
 
-    async def remove_warning(self, member, timestamp):
-        """Remove a warning from a member."""
-        await self.conn.execute(
-            "DELETE FROM warnings WHERE member_id=$1 AND timestamp=$2;",
+    async def remove_warning(self, member, warning_id):
+        """Remove a warning from a member by its ID, returning the author and
+        reason of the removed warning, or None if there was no such warning."""
+        result = await self.fetchrow(
+            "DELETE FROM warnings WHERE warning_id=$1 AND member_id=$2 "
+            "RETURNING author, reason;",
+            warning_id,
             member.id,
-            timestamp * 100,
         )
+        return (result["author"], result["reason"]) if result else None
+
+    async def remove_all_warnings(self, member):
+        """Remove every warning from a member, returning how many were removed."""
+        result = await self.execute(
+            "DELETE FROM warnings WHERE member_id=$1;", member.id
+        )
+        return int(result.split()[-1])
+
+    async def remove_warnings_between(self, member, start, end):
+        """Remove the warnings given to a member between two timestamps,
+        returning how many were removed."""
+        result = await self.execute(
+            "DELETE FROM warnings WHERE member_id=$1 AND timestamp >= $2 AND timestamp < $3;",
+            member.id,
+            round(start * 100),
+            round(end * 100),
+        )
+        return int(result.split()[-1])
+
+    async def remove_warnings_by_author(self, member, author):
+        """Remove the warnings a moderator gave to a member, returning how many
+        were removed."""
+        result = await self.execute(
+            "DELETE FROM warnings WHERE member_id=$1 AND author=$2;",
+            member.id,
+            author.id,
+        )
+        return int(result.split()[-1])
 
     async def get_warnings(self, member):
         """Retrieve all warnings given to a user."""
-        results = await self.conn.fetch(
-            "SELECT author, reason, timestamp FROM warnings WHERE member_id=$1 ORDER BY timestamp DESC;",
+        results = await self.fetch(
+            "SELECT warning_id, author, reason, timestamp FROM warnings "
+            "WHERE member_id=$1 ORDER BY timestamp DESC, warning_id DESC;",
             member.id,
         )
 
         warnings = []
         for result in results:
             warnings.append(
-                (result["author"], result["reason"], result["timestamp"] / 100)
+                (
+                    result["warning_id"],
+                    result["author"],
+                    result["reason"],
+                    result["timestamp"] / 100,
+                )
             )
 
         return warnings
 
-    async def add_rep(self, member, amount=1):
-        """Add X reputation points to the member."""
-        points = await self.get_reps(member)
-
-        if points:
-            new_points = points + amount
-            result = await self.set_reps(member, new_points)
-        else:
-            new_points = amount
-            result = await self.set_reps(member, new_points)
+    async def get_warning_count(self, member):
+        """Retrieve how many warnings have been given to a user."""
+        return await self.fetchval(
+            "SELECT COUNT(*) FROM warnings WHERE member_id=$1;", member.id
+        )
 
-        return result
+    async def get_warning_summary(self, member):
+        """Retrieve the number of warnings and the time of the latest warning."""
+        result = await self.fetchrow(
+            "SELECT COUNT(*) AS count, MAX(timestamp) AS latest FROM warnings WHERE member_id=$1;",
+            member.id,
+        )
+        if result["count"]:
+            return result["count"], result["latest"] / 100
+        return 0, None
 
-    async def set_reps(self, member, amount):
-        """Set the reps for a member to a specific value."""
-        points = await self.get_reps(member)
+    async def get_warnings_page(self, member, limit=6, offset=0):
+        """Retrieve a page of warnings given to a user, newest first."""
+        results = await self.fetch(
+            "SELECT warning_id, author, reason, timestamp FROM warnings "
+            "WHERE member_id=$1 "
+            "ORDER BY timestamp DESC, warning_id DESC LIMIT $2 OFFSET $3;",
+            member.id,
+            limit,
+            offset,
+        )
+        return [
+            (r["warning_id"], r["author"], r["reason"], r["timestamp"] / 100)
+            for r in results
+        ]
+
+    async def add_reps_bulk(self, members, amount=1):
+        """Add X reputation points to each member.
+
+        The points are clamped in the upsert itself, which sees the latest
+        points under a row lock. Adding points is that single statement. When
+        removing points, members left with none are deleted in the same
+        transaction. The members are sorted so that concurrent calls lock
+        their rows in the same order."""
+        member_ids = sorted({m.id for m in members})
+        query = (
+            "INSERT INTO reputation_points (member_id, points) "
+            "SELECT unnest($1::bigint[]), LEAST(GREATEST($2::bigint, 0), 100000000) "
+            "ON CONFLICT (member_id) DO UPDATE SET points = "
+            "GREATEST(LEAST(reputation_points.points + $2::bigint, 100000000), 0) "
+            "RETURNING member_id, points;"
+        )
+        if amount > 0:
+            results = await self.fetch(query, member_ids, amount)
+        else:
+            async with self.acquire() as conn:
+                async with conn.transaction():
+                    results = await self.run(conn.fetch, query, member_ids, amount)
+                    await self.run(
+                        conn.execute,
+                        "DELETE FROM reputation_points "
+                        "WHERE member_id = ANY($1::bigint[]) AND points <= 0;",
+                        member_ids,
+                    )
+        points = {member_id: 0 for member_id in member_ids}
+        points.update({r["member_id"]: r["points"] for r in results})
+        return points
+
+    async def set_reps_bulk(self, members, amount):
+        """Set the reps for each member to a specific value in a single statement."""
+        member_ids = list({m.id for m in members})
         if amount > 100000000:
             amount = 100000000
         if amount < 0:
             amount = 0
-        if points:
-            if amount != 0:
-                await self.conn.execute(
-                    "UPDATE reputation_points SET points=$1 WHERE member_id=$2;",
-                    amount,
-                    member.id,
-                )
-            else:
-                await self.conn.execute(
-                    "DELETE FROM reputation_points WHERE member_id=$1", member.id
-                )
-        elif amount != 0:
-            await self.conn.execute(
-                "INSERT INTO reputation_points (member_id, points) VALUES ($1, $2);",
-                member.id,
+        if amount != 0:
+            await self.execute(
+                "INSERT INTO reputation_points (member_id, points) "
+                "SELECT unnest($1::bigint[]), $2 "
+                "ON CONFLICT (member_id) DO UPDATE SET points = EXCLUDED.points;",
+                member_ids,
                 amount,
             )
-
-        return amount
+        else:
+            await self.execute(
+                "DELETE FROM reputation_points WHERE member_id = ANY($1::bigint[]);",
+                member_ids,
+            )
+        return {member_id: amount for member_id in member_ids}
 
     async def get_reps(self, member):
         """Retrieve the reputation points for a member."""
-        reps = await self.conn.fetchrow(
+        reps = await self.fetchrow(
             "SELECT points FROM reputation_points WHERE member_id=$1;", member.id
         )
         if reps:
@@ -346,11 +974,11 @@ class Database:
 
     async def get_top_reps(self, amount=10):
         """Retrieve the top X people by reps."""
-        results = await self.conn.fetch(
+        results = await self.fetch(
             "SELECT * FROM reputation_points ORDER BY points DESC LIMIT $1;", amount
         )
         return [(r["member_id"], r["points"]) for r in results]
 
     async def clear_reputations(self):
         """Remove all reputations from the table."""
-        await self.conn.execute("DELETE FROM reputation_points;")
+        await self.execute("DELETE FROM reputation_points;")
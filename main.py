@@ -1,13 +1,38 @@
 from discord.ext import commands
-from settings import DISCORD_TOKEN
+from settings import DISCORD_TOKEN, STORAGE_BACKEND
 from database import Database
+from sqlite_storage import SQLiteStorage, MemoryStorage
+from web import WebClient
+import asyncio
 import time
 import logging
 import os
 
 
+STORAGE_BACKENDS = {
+    "postgres": Database,
+    "sqlite": SQLiteStorage,
+    "memory": MemoryStorage,
+}
+
+
 class Bot(commands.Bot):
-    database = Database()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.database = STORAGE_BACKENDS[STORAGE_BACKEND]()
+        self.web = WebClient()
+
+    async def start(self, *args, **kwargs):
+        """Connect to the database while logging in, then connect to the gateway."""
+        reconnect = kwargs.pop("reconnect", True)
+        await asyncio.gather(
+            self.database.connect_to_database(), self.login(*args, **kwargs)
+        )
+        await self.connect(reconnect=reconnect)
+
+    async def close(self):
+        await super().close()
+        await asyncio.gather(self.database.close(), self.web.close())
 
 
 if __name__ == "__main__":
@@ -22,4 +47,5 @@ if __name__ == "__main__":
     bot.load_extension("cogs.fun")
     bot.load_extension("cogs.events")
     bot.load_extension("cogs.corona")
+    bot.load_extension("cogs.maintenance")
     bot.run(DISCORD_TOKEN)
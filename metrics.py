@@ -0,0 +1,131 @@
+import bisect
+import collections
+import logging
+import sys
+import time
+from settings import SLOW_QUERY_THRESHOLD
+
+
+# Upper bounds of the latency histogram buckets in seconds. Anything slower
+# falls into a final overflow bucket.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+# The storage helpers which run queries on behalf of the data methods.
+QUERY_HELPERS = {"execute", "fetch", "fetchrow", "fetchval", "run", "run_many"}
+
+SLOW_QUERY_HISTORY = 20
+
+logger = logging.getLogger(__name__)
+
+
+def find_caller():
+    """Find the name of the storage method which issued the current query."""
+    frame = sys._getframe(1)
+    while frame and (
+        frame.f_code.co_filename == __file__ or frame.f_code.co_name in QUERY_HELPERS
+    ):
+        frame = frame.f_back
+    return frame.f_code.co_name if frame else "unknown"
+
+
+def percentile(histogram, fraction):
+    """Estimate a latency percentile as the upper bound of its histogram bucket,
+    or None if it falls in the overflow bucket."""
+    target = sum(histogram) * fraction
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, histogram):
+        seen += count
+        if seen >= target:
+            return bound
+
+
+class QueryTimer:
+    def __init__(self, metrics, query, args):
+        self.metrics = metrics
+        self.query = query
+        self.args = args
+        self.rows = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        self.metrics.record(
+            self.query, self.args, elapsed, self.rows, failed=exc_type is not None
+        )
+
+
+class QueryMetrics:
+    """Query counts, latency histograms and rows returned for each storage
+    method, and a log of the slowest queries."""
+
+    def __init__(self, slow_query_threshold=SLOW_QUERY_THRESHOLD):
+        self.slow_query_threshold = slow_query_threshold
+        self.methods = {}
+        self.slow_queries = collections.deque(maxlen=SLOW_QUERY_HISTORY)
+        self.started = time.time()
+
+    def measure(self, query, args=()):
+        """Time a query, recording it when the block exits. Set `rows` on the
+        returned timer to record how many rows the query returned."""
+        return QueryTimer(self, query, args)
+
+    def record(self, query, args, elapsed, rows=0, failed=False):
+        method = find_caller()
+        stats = self.methods.get(method)
+        if stats is None:
+            stats = self.methods[method] = {
+                "queries": 0,
+                "errors": 0,
+                "rows": 0,
+                "total_time": 0,
+                "max_time": 0,
+                "histogram": [0] * (len(LATENCY_BUCKETS) + 1),
+            }
+        stats["queries"] += 1
+        stats["errors"] += failed
+        stats["rows"] += rows
+        stats["total_time"] += elapsed
+        stats["max_time"] = max(stats["max_time"], elapsed)
+        stats["histogram"][bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+        if elapsed >= self.slow_query_threshold:
+            params = repr(args)[:200]
+            logger.warning(
+                f"Slow query in {method} took {round(elapsed * 1000)}ms: {query} {params}"
+            )
+            self.slow_queries.append(
+                {
+                    "method": method,
+                    "query": query,
+                    "params": params,
+                    "time": elapsed,
+                    "at": time.time(),
+                }
+            )
+
+    def snapshot(self):
+        """Retrieve a copy of the metrics with the averages and percentiles filled in."""
+        methods = {}
+        for method, stats in self.methods.items():
+            methods[method] = dict(
+                stats,
+                histogram=list(stats["histogram"]),
+                average_time=stats["total_time"] / stats["queries"],
+                p50=percentile(stats["histogram"], 0.5),
+                p95=percentile(stats["histogram"], 0.95),
+            )
+        return {
+            "since": self.started,
+            "slow_query_threshold": self.slow_query_threshold,
+            "buckets": list(LATENCY_BUCKETS),
+            "methods": methods,
+            "slow_queries": list(self.slow_queries),
+        }
+
+    def reset(self):
+        self.methods.clear()
+        self.slow_queries.clear()
+        self.started = time.time()
@@ -1,10 +1,40 @@
 import os
 
-DATABASE_URL = os.environ["DATABASE_URL"]
+DATABASE_URL = os.environ.get("DATABASE_URL")
 DISCORD_TOKEN = os.environ["DISCORD_TOKEN"]
 MERRIAM_WEBSTER_KEY = os.environ["MERRIAM_WEBSTER_KEY"]
 TWITTER_CONSUMER_KEY = os.environ["TWITTER_CONSUMER_KEY"]
 TWITTER_CONSUMER_SECRET = os.environ["TWITTER_CONSUMER_SECRET"]
 IMGUR_CLIENT_ID = os.environ["IMGUR_CLIENT_ID"]
 
+# Either "postgres", "sqlite" for a local file at SQLITE_PATH, or "memory".
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "postgres")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "watson.db")
+
+DATABASE_POOL_MIN_SIZE = int(os.environ.get("DATABASE_POOL_MIN_SIZE", 2))
+DATABASE_POOL_MAX_SIZE = int(os.environ.get("DATABASE_POOL_MAX_SIZE", 10))
+DATABASE_ACQUIRE_TIMEOUT = float(os.environ.get("DATABASE_ACQUIRE_TIMEOUT", 10))
+# Queries slower than this many seconds are logged with their parameters.
+SLOW_QUERY_THRESHOLD = float(os.environ.get("SLOW_QUERY_THRESHOLD", 0.5))
+
+# Either "rows" for one row per setting, or "document" for a single JSONB row.
+SETTINGS_STORAGE = os.environ.get("SETTINGS_STORAGE", "rows")
+
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 100))
+HTTP_POOL_SIZE_PER_HOST = int(os.environ.get("HTTP_POOL_SIZE_PER_HOST", 10))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 15))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 2))
+HTTP_DNS_CACHE_TTL = int(os.environ.get("HTTP_DNS_CACHE_TTL", 300))
+# Maximum total size in bytes of the responses kept in memory.
+HTTP_CACHE_SIZE = int(os.environ.get("HTTP_CACHE_SIZE", 16 * 1024 * 1024))
+# Directory for the persistent response cache, which is disabled if unset.
+HTTP_CACHE_DIR = os.environ.get("HTTP_CACHE_DIR")
+HTTP_DISK_CACHE_SIZE = int(os.environ.get("HTTP_DISK_CACHE_SIZE", 256 * 1024 * 1024))
+
+ROW_BUDGET = int(os.environ.get("ROW_BUDGET", 10000))
+ROW_BUDGET_WARNING = float(os.environ.get("ROW_BUDGET_WARNING", 0.9))
+TWEET_RETENTION = int(os.environ.get("TWEET_RETENTION", 100))
+WARNING_RETENTION_DAYS = int(os.environ.get("WARNING_RETENTION_DAYS", 365))
+WARNING_ARCHIVE_DIR = os.environ.get("WARNING_ARCHIVE_DIR")
+
 EMBED_ACCENT_COLOUR = 0xF2F2F2  # White
@@ -0,0 +1,585 @@
+import json
+import os
+import sqlite3
+import time
+import zlib
+from settings import SETTINGS_STORAGE, SQLITE_PATH
+from storage import Storage
+
+
+# The whole schema, equivalent to the PostgreSQL tables after every migration.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reputation_points (member_id INTEGER PRIMARY KEY, points INTEGER);
+CREATE TABLE IF NOT EXISTS warnings (warning_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    member_id INTEGER, author INTEGER, reason TEXT, timestamp INTEGER);
+CREATE INDEX IF NOT EXISTS warnings_member_id_timestamp_idx ON warnings (member_id, timestamp);
+CREATE TABLE IF NOT EXISTS temporary_punishments
+    (member_id INTEGER, guild_id INTEGER, type TEXT, expiry_date INTEGER);
+CREATE INDEX IF NOT EXISTS temporary_punishments_expiry_date_idx
+    ON temporary_punishments (expiry_date);
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS settings_document
+    (id INTEGER PRIMARY KEY CHECK (id = 1), data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS helper_roles (guild_id INTEGER, channel_id INTEGER, role_id INTEGER,
+    UNIQUE (guild_id, channel_id, role_id));
+CREATE TABLE IF NOT EXISTS assign_role_reactions
+    (message_id INTEGER, emoji TEXT, role_id INTEGER, nick_addition TEXT, UNIQUE (message_id, emoji));
+CREATE TABLE IF NOT EXISTS demographic_roles (role_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS tags (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS jail_members (member_id INTEGER PRIMARY KEY, roles TEXT);
+CREATE TABLE IF NOT EXISTS join_roles (role_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS corona_tweets (tweet_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS warning_archives (archive_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    archived_at INTEGER, warnings INTEGER, data BLOB);
+PRAGMA user_version = 1;
+"""
+
+
+def placeholders(values):
+    return ", ".join("?" for _ in values)
+
+
+class SQLiteStorage(Storage):
+    """A storage backend for a local SQLite database.
+
+    SQLite runs in-process, so queries run directly on the event loop without
+    a network round trip, and this process is always the leader."""
+
+    def __init__(self, path=SQLITE_PATH, settings_storage=SETTINGS_STORAGE):
+        super().__init__(settings_storage)
+        self.path = path
+        self.conn = None
+
+    async def connect_to_database(self):
+        self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        self.is_leader = True
+        self.leadership.set()
+        await self.load_caches()
+        self.ready.set()
+
+    async def close(self):
+        if self.conn:
+            self.conn.close()
+
+    def run(self, query, *args):
+        """Run a statement and fetch its rows, recording it in the query metrics."""
+        with self.metrics.measure(query, args) as timer:
+            rows = self.conn.execute(query, args).fetchall()
+            timer.rows = len(rows)
+        return rows
+
+    def run_many(self, query, params):
+        """Run a statement once for each set of parameters, recording it in the
+        query metrics."""
+        with self.metrics.measure(query, params):
+            self.conn.executemany(query, params)
+
+    async def execute(self, query, *args):
+        """Execute a statement and commit it, returning the number of rows changed."""
+        with self.conn, self.metrics.measure(query, args):
+            return self.conn.execute(query, args).rowcount
+
+    async def fetch(self, query, *args):
+        """Fetch all rows for a query."""
+        return self.run(query, *args)
+
+    async def fetchrow(self, query, *args):
+        """Fetch the first row for a query."""
+        rows = self.run(query, *args)
+        if rows:
+            return rows[0]
+
+    async def fetchval(self, query, *args):
+        """Fetch a single value for a query."""
+        row = await self.fetchrow(query, *args)
+        if row:
+            return row[0]
+
+    def get_pool_stats(self):
+        """Retrieve statistics about the connection pool, which for SQLite is a
+        single connection."""
+        return {
+            "size": 1,
+            "idle": 1,
+            "min_size": 1,
+            "max_size": 1,
+            "in_use": 0,
+            "waiting": 0,
+            "acquires": 0,
+            "timeouts": 0,
+            "average_acquire_time": 0,
+            "max_acquire_time": 0,
+        }
+
+    async def get_schema_version(self):
+        return await self.fetchval("PRAGMA user_version;")
+
+    async def get_index_usage(self):
+        """Retrieve the indexes on each table. SQLite does not count scans."""
+        results = await self.fetch(
+            "SELECT t.name AS table_name, i.name AS index_name FROM sqlite_master t "
+            "LEFT JOIN sqlite_master i ON i.tbl_name = t.name AND i.type = 'index' "
+            "WHERE t.type = 'table' AND t.name NOT LIKE 'sqlite_%' "
+            "ORDER BY t.name, i.name;"
+        )
+        return [(r["table_name"], None, r["index_name"], None) for r in results]
+
+    async def new_tweet(self, tweet):
+        inserted = await self.execute(
+            "INSERT OR IGNORE INTO corona_tweets (tweet_id) VALUES (?);", tweet.id
+        )
+        return not inserted
+
+    async def prune_tweets(self, keep, dry_run=False):
+        if dry_run:
+            return await self.fetchval(
+                "SELECT MAX(COUNT(*) - ?, 0) FROM corona_tweets;", keep
+            )
+        return await self.execute(
+            "DELETE FROM corona_tweets WHERE tweet_id NOT IN "
+            "(SELECT tweet_id FROM corona_tweets ORDER BY tweet_id DESC LIMIT ?);",
+            keep,
+        )
+
+    async def archive_warnings(self, before, archive_dir=None, dry_run=False):
+        if dry_run:
+            return await self.fetchval(
+                "SELECT COUNT(*) FROM warnings WHERE timestamp < ?;",
+                round(before * 100),
+            )
+
+        with self.conn:
+            results = self.run(
+                "SELECT warning_id, member_id, author, reason, timestamp FROM warnings "
+                "WHERE timestamp < ?;",
+                round(before * 100),
+            )
+            if not results:
+                return 0
+            self.run("DELETE FROM warnings WHERE timestamp < ?;", round(before * 100))
+            archived_at = int(time.time())
+            data = zlib.compress(json.dumps([dict(r) for r in results]).encode())
+            if archive_dir:
+                path = os.path.join(archive_dir, f"warnings-{archived_at}.json.z")
+                with open(path, "wb") as f:
+                    f.write(data)
+            else:
+                self.run(
+                    "INSERT INTO warning_archives (archived_at, warnings, data) "
+                    "VALUES (?, ?, ?);",
+                    archived_at,
+                    len(results),
+                    data,
+                )
+        return len(results)
+
+    async def get_tables(self):
+        results = await self.fetch(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%';"
+        )
+        return [r["name"] for r in results]
+
+    async def get_table_stats(self, exact=False):
+        """Retrieve the row count and on-disk size of every table. Row counts
+        are always exact, since counting a local database is cheap."""
+        tables = await self.get_tables()
+        counts = await self.fetch(
+            " UNION ALL ".join(
+                f"SELECT '{table}' AS table_name, COUNT(*) AS rows FROM \"{table}\""
+                for table in tables
+            )
+        )
+        try:
+            sizes = await self.fetch(
+                "SELECT name, SUM(pgsize) AS size FROM dbstat GROUP BY name;"
+            )
+        except sqlite3.OperationalError:
+            # dbstat is an optional extension which may not be compiled in.
+            sizes = []
+        sizes = {r["name"]: r["size"] for r in sizes}
+        return {
+            r["table_name"]: {"rows": r["rows"], "size": sizes.get(r["table_name"], 0)}
+            for r in counts
+        }
+
+    async def add_jail_member(self, member, roles):
+        roles_string = ";".join([str(r.id) for r in roles[1:]])
+        await self.execute(
+            "INSERT INTO jail_members (member_id, roles) VALUES (?, ?);",
+            member.id,
+            roles_string,
+        )
+
+    async def remove_jail_member(self, member):
+        record = await self.fetchrow(
+            "SELECT * FROM jail_members WHERE member_id=?;", member.id
+        )
+        role_ids = [int(rid) for rid in record["roles"].split(";")]
+        await self.execute("DELETE FROM jail_members WHERE member_id=?;", member.id)
+        return role_ids
+
+    async def get_tag(self, tag):
+        return await self.fetchval("SELECT value FROM tags WHERE key=?;", tag)
+
+    async def add_tag(self, tag, definition):
+        await self.execute(
+            "INSERT INTO tags (key, value) VALUES (?, ?);", tag, definition
+        )
+
+    async def remove_tag(self, tag):
+        await self.execute("DELETE FROM tags WHERE key=?;", tag)
+
+    async def load_settings(self):
+        if self.settings_storage == "document":
+            data = await self.fetchval("SELECT data FROM settings_document;")
+            if data is None:
+                data = await self.convert_settings_to_document()
+            return json.loads(data)
+        results = await self.fetch("SELECT key, value FROM settings;")
+        return {r["key"]: r["value"] for r in results}
+
+    async def convert_settings_to_document(self):
+        """Move the settings rows into the settings document."""
+        with self.conn:
+            results = self.run("SELECT key, value FROM settings;")
+            data = json.dumps({r["key"]: r["value"] for r in results})
+            self.run("INSERT INTO settings_document (id, data) VALUES (1, ?);", data)
+            self.run("DELETE FROM settings;")
+        return data
+
+    async def set_settings(self, settings):
+        with self.conn:
+            if self.settings_storage == "document":
+                rows = self.run("SELECT data FROM settings_document;")
+                data = json.loads(rows[0]["data"]) if rows else {}
+                data.update(settings)
+                self.run(
+                    "INSERT INTO settings_document (id, data) VALUES (1, ?) "
+                    "ON CONFLICT (id) DO UPDATE SET data = excluded.data;",
+                    json.dumps(data),
+                )
+            else:
+                self.run_many(
+                    "INSERT INTO settings (key, value) VALUES (?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET value = excluded.value;",
+                    list(settings.items()),
+                )
+        self.settings.update(settings)
+
+    async def add_demographic_role(self, role):
+        await self.execute(
+            "INSERT INTO demographic_roles (role_id) VALUES (?);", role.id
+        )
+
+    async def remove_demographic_role(self, role):
+        await self.execute("DELETE FROM demographic_roles WHERE role_id=?;", role.id)
+
+    async def get_demographic_roles(self):
+        result = await self.fetch("SELECT role_id FROM demographic_roles;")
+        if result:
+            return [r["role_id"] for r in result]
+
+    async def add_join_role(self, role):
+        await self.execute("INSERT INTO join_roles (role_id) VALUES (?);", role.id)
+
+    async def remove_join_role(self, role):
+        await self.execute("DELETE FROM join_roles WHERE role_id=?;", role.id)
+
+    async def get_join_roles(self):
+        result = await self.fetch("SELECT role_id FROM join_roles;")
+        return [r["role_id"] for r in result]
+
+    async def add_helper_role(self, channel, role):
+        helper_roles = await self.get_helper_roles(channel)
+        if role.id in helper_roles:
+            return
+        await self.execute(
+            "INSERT OR IGNORE INTO helper_roles (guild_id, channel_id, role_id) VALUES (?, ?, ?);",
+            channel.guild.id,
+            channel.id,
+            role.id,
+        )
+        self.helper_roles[channel.id].add(role.id)
+
+    async def get_helper_roles(self, channel):
+        if channel.id in self.helper_roles:
+            self.helper_role_hits += 1
+        else:
+            self.helper_role_misses += 1
+            results = await self.fetch(
+                "SELECT role_id FROM helper_roles WHERE guild_id=? AND channel_id=?;",
+                channel.guild.id,
+                channel.id,
+            )
+            self.helper_roles[channel.id] = {r["role_id"] for r in results}
+        return list(self.helper_roles[channel.id])
+
+    async def get_all_helper_roles(self):
+        results = await self.fetch("SELECT channel_id, role_id FROM helper_roles;")
+        helper_roles = {}
+        for r in results:
+            helper_roles.setdefault(r["channel_id"], set()).add(r["role_id"])
+        self.helper_roles = helper_roles
+        return {channel_id: set(roles) for channel_id, roles in helper_roles.items()}
+
+    async def remove_helper_roles(self, channel, role_ids):
+        role_ids = list(role_ids)
+        await self.execute(
+            "DELETE FROM helper_roles WHERE guild_id=? AND channel_id=? "
+            f"AND role_id IN ({placeholders(role_ids)});",
+            channel.guild.id,
+            channel.id,
+            *role_ids,
+        )
+        self.helper_roles.get(channel.id, set()).difference_update(role_ids)
+
+    async def prune_helper_roles(self, channel_ids=(), role_ids=()):
+        channel_ids = set(channel_ids)
+        role_ids = set(role_ids)
+        if not channel_ids and not role_ids:
+            return
+        await self.execute(
+            f"DELETE FROM helper_roles WHERE channel_id IN ({placeholders(channel_ids)}) "
+            f"OR role_id IN ({placeholders(role_ids)});",
+            *channel_ids,
+            *role_ids,
+        )
+        for channel_id in channel_ids:
+            self.helper_roles.pop(channel_id, None)
+        for roles in self.helper_roles.values():
+            roles.difference_update(role_ids)
+
+    async def load_role_reactions(self):
+        results = await self.fetch(
+            "SELECT message_id, emoji, role_id, nick_addition FROM assign_role_reactions;"
+        )
+        role_reactions = {}
+        for r in results:
+            role_reactions.setdefault(r["message_id"], {})[r["emoji"]] = (
+                r["role_id"],
+                r["nick_addition"],
+            )
+        return role_reactions
+
+    async def add_role_reaction(self, message_id, emoji, role, nick):
+        await self.execute(
+            "INSERT INTO assign_role_reactions (message_id, emoji, role_id, nick_addition) "
+            "VALUES (?, ?, ?, ?) ON CONFLICT (message_id, emoji) "
+            "DO UPDATE SET role_id = excluded.role_id, nick_addition = excluded.nick_addition;",
+            message_id,
+            str(emoji),
+            role.id,
+            nick,
+        )
+        self.role_reactions.setdefault(message_id, {})[str(emoji)] = (role.id, nick)
+
+    async def remove_role_reaction(self, message_id, emoji):
+        await self.execute(
+            "DELETE FROM assign_role_reactions WHERE message_id=? AND emoji=?;",
+            message_id,
+            str(emoji),
+        )
+        reactions = self.role_reactions.get(message_id, {})
+        reactions.pop(str(emoji), None)
+        if not reactions:
+            self.role_reactions.pop(message_id, None)
+
+    async def new_punishment(self, member, punishment_type, expire_date):
+        await self.execute(
+            "INSERT INTO temporary_punishments (member_id, guild_id, type, expiry_date) "
+            "VALUES (?, ?, ?, ?);",
+            member.id,
+            member.guild.id,
+            punishment_type,
+            expire_date,
+        )
+
+    async def get_expired_punishments(self):
+        time_now = time.time()
+        with self.conn:
+            expired = self.run(
+                "SELECT member_id, guild_id, type FROM temporary_punishments WHERE expiry_date < ?;",
+                time_now,
+            )
+            if expired:
+                self.run(
+                    "DELETE FROM temporary_punishments WHERE expiry_date < ?;", time_now
+                )
+        return [(e["member_id"], e["guild_id"], e["type"]) for e in expired]
+
+    async def remove_expired_punishment(
+        self, member_id, guild_id, punishment_type, expire_date
+    ):
+        return await self.execute(
+            "DELETE FROM temporary_punishments "
+            "WHERE member_id=? AND guild_id=? AND type=? AND expiry_date <= ?;",
+            member_id,
+            guild_id,
+            punishment_type,
+            expire_date,
+        )
+
+    async def remove_punishments(self, member, punishment_type):
+        await self.execute(
+            "DELETE FROM temporary_punishments WHERE member_id=? AND guild_id=? AND type=?;",
+            member.id,
+            member.guild.id,
+            punishment_type,
+        )
+
+    async def get_temporary_punishments(self):
+        return await self.fetch(
+            "SELECT * FROM temporary_punishments ORDER BY expiry_date;"
+        )
+
+    async def add_warning(self, member, author, reason):
+        await self.execute(
+            "INSERT INTO warnings (member_id, author, reason, timestamp) "
+            "VALUES (?, ?, ?, ?);",
+            member.id,
+            author.id,
+            reason,
+            round(time.time() * 100),
+        )
+
+    async def remove_warning(self, member, warning_id):
+        with self.conn:
+            result = self.run(
+                "SELECT author, reason FROM warnings WHERE warning_id=? AND member_id=?;",
+                warning_id,
+                member.id,
+            )
+            if not result:
+                return None
+            self.run(
+                "DELETE FROM warnings WHERE warning_id=? AND member_id=?;",
+                warning_id,
+                member.id,
+            )
+        return result[0]["author"], result[0]["reason"]
+
+    async def remove_all_warnings(self, member):
+        return await self.execute("DELETE FROM warnings WHERE member_id=?;", member.id)
+
+    async def remove_warnings_between(self, member, start, end):
+        return await self.execute(
+            "DELETE FROM warnings WHERE member_id=? AND timestamp >= ? AND timestamp < ?;",
+            member.id,
+            round(start * 100),
+            round(end * 100),
+        )
+
+    async def remove_warnings_by_author(self, member, author):
+        return await self.execute(
+            "DELETE FROM warnings WHERE member_id=? AND author=?;",
+            member.id,
+            author.id,
+        )
+
+    async def get_warnings(self, member):
+        results = await self.fetch(
+            "SELECT warning_id, author, reason, timestamp FROM warnings "
+            "WHERE member_id=? ORDER BY timestamp DESC, warning_id DESC;",
+            member.id,
+        )
+        return [
+            (r["warning_id"], r["author"], r["reason"], r["timestamp"] / 100)
+            for r in results
+        ]
+
+    async def get_warning_count(self, member):
+        return await self.fetchval(
+            "SELECT COUNT(*) FROM warnings WHERE member_id=?;", member.id
+        )
+
+    async def get_warning_summary(self, member):
+        result = await self.fetchrow(
+            "SELECT COUNT(*) AS count, MAX(timestamp) AS latest FROM warnings WHERE member_id=?;",
+            member.id,
+        )
+        if result["count"]:
+            return result["count"], result["latest"] / 100
+        return 0, None
+
+    async def get_warnings_page(self, member, limit=6, offset=0):
+        results = await self.fetch(
+            "SELECT warning_id, author, reason, timestamp FROM warnings "
+            "WHERE member_id=? "
+            "ORDER BY timestamp DESC, warning_id DESC LIMIT ? OFFSET ?;",
+            member.id,
+            limit,
+            offset,
+        )
+        return [
+            (r["warning_id"], r["author"], r["reason"], r["timestamp"] / 100)
+            for r in results
+        ]
+
+    async def add_reps_bulk(self, members, amount=1):
+        points = {}
+        with self.conn:
+            for member_id in {m.id for m in members}:
+                current = self.run(
+                    "SELECT points FROM reputation_points WHERE member_id=?;", member_id
+                )
+                new_points = min(
+                    (current[0]["points"] if current else 0) + amount, 100000000
+                )
+                if new_points > 0:
+                    self.run(
+                        "INSERT INTO reputation_points (member_id, points) VALUES (?, ?) "
+                        "ON CONFLICT (member_id) DO UPDATE SET points = excluded.points;",
+                        member_id,
+                        new_points,
+                    )
+                else:
+                    new_points = 0
+                    self.run(
+                        "DELETE FROM reputation_points WHERE member_id=?;", member_id
+                    )
+                points[member_id] = new_points
+        return points
+
+    async def set_reps_bulk(self, members, amount):
+        member_ids = list({m.id for m in members})
+        amount = min(max(amount, 0), 100000000)
+        with self.conn:
+            if amount != 0:
+                self.run_many(
+                    "INSERT INTO reputation_points (member_id, points) VALUES (?, ?) "
+                    "ON CONFLICT (member_id) DO UPDATE SET points = excluded.points;",
+                    [(member_id, amount) for member_id in member_ids],
+                )
+            else:
+                self.run(
+                    f"DELETE FROM reputation_points WHERE member_id IN ({placeholders(member_ids)});",
+                    *member_ids,
+                )
+        return {member_id: amount for member_id in member_ids}
+
+    async def get_reps(self, member):
+        reps = await self.fetchval(
+            "SELECT points FROM reputation_points WHERE member_id=?;", member.id
+        )
+        return reps or 0
+
+    async def get_top_reps(self, amount=10):
+        results = await self.fetch(
+            "SELECT member_id, points FROM reputation_points ORDER BY points DESC LIMIT ?;",
+            amount,
+        )
+        return [(r["member_id"], r["points"]) for r in results]
+
+    async def clear_reputations(self):
+        await self.execute("DELETE FROM reputation_points;")
+
+
+class MemoryStorage(SQLiteStorage):
+    """A storage backend which keeps the bot database in memory, so the cogs
+    can be load tested without a database server. Nothing is kept after the
+    bot stops."""
+
+    def __init__(self, settings_storage=SETTINGS_STORAGE):
+        super().__init__(":memory:", settings_storage)
@@ -0,0 +1,349 @@
+import abc
+import asyncio
+import functools
+from metrics import QueryMetrics
+from settings import SETTINGS_STORAGE
+
+
+def leader_only(func):
+    """Only run a cog's background task on the leader process."""
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        if self.bot.database.is_leader:
+            return await func(self, *args, **kwargs)
+
+    return wrapper
+
+
+class Storage(abc.ABC):
+    """The interface the cogs use to store the bot's data.
+
+    Backends implement the abstract data methods below, and can't be created
+    until they implement all of them. The in-memory caches, change listeners
+    and leadership state are shared by every backend."""
+
+    def __init__(self, settings_storage=SETTINGS_STORAGE):
+        self.settings_storage = settings_storage
+        self.helper_role_hits = 0
+        self.helper_role_misses = 0
+        self.change_listeners = {}
+        self.is_leader = False
+        self.leadership = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.settings = {}
+        self.role_reactions = {}
+        self.helper_roles = {}
+        self.metrics = QueryMetrics()
+
+    @abc.abstractmethod
+    async def connect_to_database(self):
+        """Connect to the storage and load the caches."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def close(self):
+        """Close any connections held by the storage."""
+        raise NotImplementedError
+
+    async def wait_until_ready(self):
+        """Wait until the database is connected and the caches are loaded."""
+        await self.ready.wait()
+
+    async def wait_for_leadership(self):
+        """Wait until this process is the leader."""
+        await self.leadership.wait()
+
+    async def load_caches(self):
+        """Load the in-memory caches from the database."""
+        self.settings, self.role_reactions, _ = await asyncio.gather(
+            self.load_settings(),
+            self.load_role_reactions(),
+            self.get_all_helper_roles(),
+        )
+
+    def add_change_listener(self, table, callback):
+        """Call a coroutine with the changed key when another process changes a table."""
+        self.change_listeners.setdefault(table, []).append(callback)
+
+    def remove_change_listener(self, table, callback):
+        """Stop calling a coroutine when a table changes."""
+        self.change_listeners.get(table, []).remove(callback)
+
+    @abc.abstractmethod
+    def get_pool_stats(self):
+        """Retrieve statistics about the connection pool."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_schema_version(self):
+        """Retrieve the latest applied schema migration."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_index_usage(self):
+        """Retrieve how often each index and sequential scan has been used."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def new_tweet(self, tweet):
+        """Check if a tweet has been seen before."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def prune_tweets(self, keep, dry_run=False):
+        """Remove all but the latest X tweets, returning how many were removed."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def archive_warnings(self, before, archive_dir=None, dry_run=False):
+        """Move the warnings given before a timestamp into a compressed archive,
+        returning how many were archived."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_tables(self):
+        """Retrieve all table names."""
+        raise NotImplementedError
+
+    async def get_total_rows(self, exact=False):
+        """Retrieve the total rows used up."""
+        stats = await self.get_table_stats(exact=exact)
+        return sum(s["rows"] for s in stats.values())
+
+    @abc.abstractmethod
+    async def get_table_stats(self, exact=False):
+        """Retrieve the row count and on-disk size of every table."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def add_jail_member(self, member, roles):
+        """Add a member to jail."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove_jail_member(self, member):
+        """Remove a member from jail and get their previous roles."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_tag(self, tag):
+        """Get a definition for a tag."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def add_tag(self, tag, definition):
+        """Add a tag to the database."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove_tag(self, tag):
+        """Remove a tag from the database."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def load_settings(self):
+        """Load settings from database."""
+        raise NotImplementedError
+
+    async def set_setting(self, key, value):
+        """Set a setting value."""
+        await self.set_settings({key: value})
+
+    @abc.abstractmethod
+    async def set_settings(self, settings):
+        """Set several setting values at once."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def add_demographic_role(self, role):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove_demographic_role(self, role):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_demographic_roles(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def add_join_role(self, role):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove_join_role(self, role):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_join_roles(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def add_helper_role(self, channel, role):
+        """Add a helper role for a channel."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_helper_roles(self, channel):
+        """Get the helper role for a channel."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_all_helper_roles(self):
+        """Get the helper roles for every channel, refreshing the cache."""
+        raise NotImplementedError
+
+    def get_helper_role_cache_stats(self):
+        """Retrieve the hit and miss counts of the helper role cache."""
+        return {
+            "channels": len(self.helper_roles),
+            "hits": self.helper_role_hits,
+            "misses": self.helper_role_misses,
+        }
+
+    async def remove_helper_role(self, channel, role_id):
+        """Remove a helper role from a channel."""
+        await self.remove_helper_roles(channel, [role_id])
+
+    @abc.abstractmethod
+    async def remove_helper_roles(self, channel, role_ids):
+        """Remove several helper roles from a channel."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def prune_helper_roles(self, channel_ids=(), role_ids=()):
+        """Remove deleted channels and roles from the helper roles."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def load_role_reactions(self):
+        """Load the role reactions, indexed by message ID and then by emoji."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def add_role_reaction(self, message_id, emoji, role, nick):
+        """Add a role reaction."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove_role_reaction(self, message_id, emoji):
+        """Remove a role reaction."""
+        raise NotImplementedError
+
+    async def check_reaction(self, message_id, emoji):
+        """Check roles for a reaction to a message."""
+        reactions = self.role_reactions.get(message_id)
+        if reactions:
+            return reactions.get(str(emoji))
+
+    @abc.abstractmethod
+    async def new_punishment(self, member, punishment_type, expire_date):
+        """Add temporary punishment to the database."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_expired_punishments(self):
+        """Retrieve any expired punishments."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove_expired_punishment(
+        self, member_id, guild_id, punishment_type, expire_date
+    ):
+        """Remove a temporary punishment before lifting it, returning how many
+        were removed, which is 0 if it has already been lifted."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove_punishments(self, member, punishment_type):
+        """Remove every temporary punishment of a type from a member."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_temporary_punishments(self):
+        """Get all active punishments"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def add_warning(self, member, author, reason):
+        """Add a warning to a member."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove_warning(self, member, warning_id):
+        """Remove a warning from a member by its ID, returning the author and
+        reason of the removed warning, or None if there was no such warning."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove_all_warnings(self, member):
+        """Remove every warning from a member, returning how many were removed."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove_warnings_between(self, member, start, end):
+        """Remove the warnings given to a member between two timestamps,
+        returning how many were removed."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove_warnings_by_author(self, member, author):
+        """Remove the warnings a moderator gave to a member, returning how many
+        were removed."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_warnings(self, member):
+        """Retrieve all warnings given to a user."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_warning_count(self, member):
+        """Retrieve how many warnings have been given to a user."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_warning_summary(self, member):
+        """Retrieve the number of warnings and the time of the latest warning."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_warnings_page(self, member, limit=6, offset=0):
+        """Retrieve a page of warnings given to a user, newest first."""
+        raise NotImplementedError
+
+    async def add_rep(self, member, amount=1):
+        """Add X reputation points to the member."""
+        points = await self.add_reps_bulk([member], amount)
+        return points[member.id]
+
+    @abc.abstractmethod
+    async def add_reps_bulk(self, members, amount=1):
+        """Add X reputation points to each member."""
+        raise NotImplementedError
+
+    async def set_reps(self, member, amount):
+        """Set the reps for a member to a specific value."""
+        points = await self.set_reps_bulk([member], amount)
+        return points[member.id]
+
+    @abc.abstractmethod
+    async def set_reps_bulk(self, members, amount):
+        """Set the reps for each member to a specific value."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_reps(self, member):
+        """Retrieve the reputation points for a member."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_top_reps(self, amount=10):
+        """Retrieve the top X people by reps."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def clear_reputations(self):
+        """Remove all reputations from the table."""
+        raise NotImplementedError
@@ -0,0 +1,180 @@
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import urlencode
+import aiohttp
+from cache import ResponseCache, DiskCache
+from settings import (
+    HTTP_POOL_SIZE,
+    HTTP_POOL_SIZE_PER_HOST,
+    HTTP_TIMEOUT,
+    HTTP_RETRIES,
+    HTTP_DNS_CACHE_TTL,
+    HTTP_CACHE_DIR,
+)
+
+
+# Statuses worth retrying, since they are usually temporary.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_BACKOFF = 0.5
+RETRY_MAX_DELAY = 10
+
+# Query parameters holding credentials, which are left out of cache keys so
+# they are never written to the disk cache.
+CREDENTIAL_PARAMS = {"key", "api_key", "apikey", "access_token", "token"}
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(url, params=None):
+    """Identify a GET request by its URL and sorted query parameters, leaving
+    out any credentials."""
+    params = {k: v for k, v in (params or {}).items() if k not in CREDENTIAL_PARAMS}
+    if params:
+        url += "?" + urlencode(sorted(params.items()))
+    return url
+
+
+class Response:
+    """A response whose body has already been read, so its connection is back
+    in the pool."""
+
+    def __init__(self, url, status, headers, body, encoding="utf-8", expires=None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.encoding = encoding
+        self.expires = expires
+
+    def read(self):
+        return self.body
+
+    def text(self):
+        return self.body.decode(self.encoding, errors="replace")
+
+    def json(self):
+        return json.loads(self.text())
+
+
+class WebClient:
+    """The bot's HTTP client, which keeps one pooled session open for every
+    outbound request instead of a new session and connection per request."""
+
+    def __init__(
+        self,
+        limit=HTTP_POOL_SIZE,
+        limit_per_host=HTTP_POOL_SIZE_PER_HOST,
+        timeout=HTTP_TIMEOUT,
+        retries=HTTP_RETRIES,
+        dns_cache_ttl=HTTP_DNS_CACHE_TTL,
+        cache_dir=HTTP_CACHE_DIR,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.dns_cache_ttl = dns_cache_ttl
+        self.session = None
+        self.cache = ResponseCache()
+        self.disk_cache = DiskCache(cache_dir) if cache_dir else None
+
+    def get_session(self):
+        """Get the session, creating it on first use inside the running loop."""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+        if self.disk_cache:
+            self.disk_cache.close()
+
+    async def request(self, method, url, *, retries=None, **options):
+        """Make a request and read the response.
+
+        Connection errors, timeouts and temporary error statuses are retried
+        with exponential backoff. Only GET requests are retried by default, as
+        other methods may not be safe to repeat."""
+        if retries is None:
+            retries = self.retries if method == "GET" else 0
+
+        for attempt in range(retries + 1):
+            delay = min(RETRY_BACKOFF * 2**attempt, RETRY_MAX_DELAY)
+            try:
+                async with self.get_session().request(method, url, **options) as r:
+                    body = await r.read()
+                    response = Response(
+                        str(r.url), r.status, r.headers, body, r.charset or "utf-8"
+                    )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == retries:
+                    raise
+                logger.warning(f"{method} {url} failed ({e!r}), retrying in {delay}s")
+            else:
+                if response.status not in RETRY_STATUSES or attempt == retries:
+                    return response
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = min(int(retry_after), RETRY_MAX_DELAY)
+                logger.warning(
+                    f"{method} {url} returned {response.status}, retrying in {delay}s"
+                )
+            await asyncio.sleep(delay)
+
+    async def get(self, url, *, ttl=None, **options):
+        """Make a GET request. If a `ttl` is given, successful responses are
+        cached for that many seconds, keyed by the URL and query parameters."""
+        if not ttl:
+            return await self.request("GET", url, **options)
+        key = cache_key(url, options.get("params"))
+        return await self.cache.fetch(
+            key, ttl, lambda: self.get_from_disk(key, ttl, url, options)
+        )
+
+    async def get_from_disk(self, key, ttl, url, options):
+        """Get a response from the disk cache, revalidating it with the server
+        if it has expired, or make the request if it isn't cached."""
+        if self.disk_cache is None:
+            return await self.request("GET", url, **options)
+
+        entry = await self.disk_cache.get(key)
+        if entry:
+            cached = Response(
+                url,
+                entry["status"],
+                {"ETag": entry["etag"], "Last-Modified": entry["last_modified"]},
+                entry["data"],
+                entry["encoding"],
+                entry["expires"],
+            )
+            if entry["expires"] > time.time():
+                return cached
+            headers = dict(options.get("headers") or {})
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+            options = dict(options, headers=headers)
+
+        response = await self.request("GET", url, **options)
+        if response.status == 304 and entry:
+            await self.disk_cache.refresh(key, ttl)
+            cached.expires = time.time() + ttl
+            return cached
+        if response.status == 200:
+            await self.disk_cache.set(key, response, ttl)
+        return response
+
+    async def post(self, url, **options):
+        return await self.request("POST", url, **options)